@@ -7,12 +7,7 @@ def ui_raw(options):
     win.configure(background='white')
     win.title('Manual component classification. Choose and click OK to continue.')
 
-    if options['figsize'] == 'small':
-        sz = [700, 560]
-    elif options['figsize'] == 'medium':
-        sz = [900, 600]
-    elif options['figsize'] == 'large':
-        sz = [1200, 900]
+    sz = figure_size(options)
 
     # center window horizontally and vertically
     sw = win.winfo_screenwidth()
@@ -28,38 +23,21 @@ def ui_raw(options):
 
 def ui_check(self):
 
-    import numpy as np
+    import TMSRepair.TMSRepair_misc as misc
     import tkinter as tk
     from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-    import matplotlib.pyplot as plt
 
-    # extract data from instance
-    ch_idx = [  i for i, chan in enumerate(self.epochs.ch_names) 
-                if chan in self.options['chanpicks']]
-
-    post= np.mean(self.post, 2)
-    pre = np.mean(self.epochs._data[:,ch_idx, :], 0)
+    # the cleaning is linear, so the mean over epochs after cleaning 
+    # is the projection of the mean over epochs before
+    pre = self.S.data_mean()
+    post = misc.project(pre[None, :, :].copy(), self.proj, self.mean)[0]
     rel_time = self.epochs.times*1000
 
     win = ui_raw(self.options)
     win.configure(background='white')
     win.title('Are you satisfied with the correction?')
 
-    # plot pre-/post
-    fig, (sp1, sp2) = plt.subplots(2)
-
-    sp1.plot(rel_time, pre.T, 'k', linewidth=0.5)
-    sp1.title.set_text('Pre')
-    sp1.set_xlabel('time [ms]')
-    sp1.set_ylabel('amplitude [\muV]') 
-
-    sp2.plot(rel_time, post.T, 'k', linewidth=0.5)
-    sp2.title.set_text('Post')
-    sp2.set_xlabel('time [ms]')
-    sp2.set_ylabel('amplitude [\muV]') 
-
-    # make ylimits equal in both plots
-    sp2.set_ylim(sp1.get_ylim())
+    fig = check_figure(pre, post, rel_time, npix=figure_size(self.options)[0])
 
     canvas = FigureCanvasTkAgg(fig)
     widget = canvas.get_tk_widget()
@@ -90,6 +68,36 @@ def ui_check(self):
     return redo
 
 
+def check_figure(pre, post, rel_time, figsize=None, npix=None):
+
+    from matplotlib.figure import Figure
+    import TMSRepair.TMSRepair_misc as misc
+
+    # only the min/max envelope per pixel column is drawn
+    if npix is not None:
+        _, pre = misc.minmax_envelope(rel_time, pre, npix)
+        rel_time, post = misc.minmax_envelope(rel_time, post, npix)
+
+    # plot pre-/post, on a figure independent of pyplot and its backend
+    fig = Figure(figsize=figsize)
+    (sp1, sp2) = fig.subplots(2)
+
+    sp1.plot(rel_time, pre.T, 'k', linewidth=0.5)
+    sp1.title.set_text('Pre')
+    sp1.set_xlabel('time [ms]')
+    sp1.set_ylabel('amplitude [\muV]') 
+
+    sp2.plot(rel_time, post.T, 'k', linewidth=0.5)
+    sp2.title.set_text('Post')
+    sp2.set_xlabel('time [ms]')
+    sp2.set_ylabel('amplitude [\muV]') 
+
+    # make ylimits equal in both plots
+    sp2.set_ylim(sp1.get_ylim())
+
+    return fig
+
+
 def ui_redo():
 
     import tkinter as tk
@@ -123,104 +131,510 @@ def ui_redo():
 
 
 
+# names of the component classes, indexed by class number - 1
+art_types = ["neural", "tms muscle artifact", 
+            "eyeblink", "lateral eye movement", 
+            "persistent muscle activity", "electrode noise"]
+
+
+
+def topo_positions(ch_names):
+
+    from mne.channels import read_layout
+    import numpy as np
+
+    # adjust channel positions from default mne layout, 
+    # original from mkeute (github)
+    layout = read_layout("EEG1005")
+
+    return (np.asanyarray([layout.pos[layout.names.index(ch)] for ch in ch_names])[:, 0:2]- 0.5) / 5
+
+
+
+def topomap(data, pos, ch_names, axes):
+
+    from mne.viz import plot_topomap
+    import inspect
+
+    # plot topographical plot with mne, with channel names 
+    # (show_names is not needed anymore in newer mne versions)
+    if 'show_names' in inspect.signature(plot_topomap).parameters:
+        return plot_topomap(data, pos, names=ch_names, show_names=True, axes=axes, show=False)
+
+    return plot_topomap(data, pos, names=ch_names, axes=axes, show=False)
+
+
+
+def panel_data(inst, compnum):
+
+    from scipy.stats import zscore
+    import numpy as np
+    import TMSRepair.TMSRepair_misc as misc
+
+    rel_time = inst.epochs.times*1000
+    temp = inst.S[compnum, :, :]
+
+    # spectrum in the chosen scale
+    if inst.options['freqscale'] == 'raw':
+        spectrum = inst.fftbins[compnum, :]
+    elif inst.options['freqscale'] == 'log':
+        spectrum = np.log(inst.fftbins[compnum, :])
+    elif inst.options['freqscale'] == 'log10':
+        spectrum = np.log10(inst.fftbins[compnum, :])
+    elif inst.options['freqscale'] == 'db':
+        spectrum = 10*np.log10(inst.fftbins[compnum, :])
+
+    # time course matrix in the plotted time window
+    tp1 = np.argmin(np.abs(rel_time - inst.options['plottimex'][0]))
+    tp2 = np.argmin(np.abs(rel_time - inst.options['plottimex'][1]))
+
+    # lines and matrix are decimated for display to the pixels of one panel
+    sz = figure_size(inst.options)
+    time, timecourse = misc.minmax_envelope(rel_time, np.mean(temp, 1), sz[0]//2)
+
+    return {'time': time,
+            'timecourse': timecourse, 
+            'topo': inst.A[:, compnum], 
+            'spectrum': spectrum, 
+            'matrix': misc.decimate_image(np.transpose(zscore(temp[tp1:tp2, :])), (sz[1]//2, sz[0]//2))}
+
+
+
+def figure_size(options):
+
+    # size of the UI windows in pixels
+    if options['figsize'] == 'small':
+        return [700, 560]
+    elif options['figsize'] == 'medium':
+        return [900, 600]
+    elif options['figsize'] == 'large':
+        return [1200, 900]
+
+
+
+def panel_key(inst):
+
+    import hashlib
+    import numpy as np
+    import TMSRepair.TMSRepair_misc as misc
+
+    # the panels only depend on the decomposition, the spectra and the display settings
+    h = hashlib.sha1()
+    for arr in [inst.W, inst.A, inst.fftbins, inst.epochs.times]:
+        h.update(np.ascontiguousarray(arr).tobytes())
+
+    h.update(repr(misc.freeze_param({opt: inst.options[opt] for opt in 
+                ['chanpicks', 'plottimex', 'plotfreqx', 'freqscale', 'figsize']})).encode())
+
+    return h.hexdigest()
+
+
+
+def render_panel(fname, panel, freq, pos, ch_names, clr, sz):
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    # drawn on its own Agg canvas, without pyplot, so the backend of the calling process is not changed
+    fig = Figure(figsize=(sz[0]/100, sz[1]/100), dpi=100)
+    FigureCanvasAgg(fig)
+    ((sp1, sp2), (sp3, sp4)) = fig.subplots(2, 2)
+
+    sp1.plot(panel['time'], panel['timecourse'], clr)
+    sp1.title.set_text('Component time series across channels')
+    sp1.set_xlabel('Time [ms]')
+    sp1.set_ylabel('Amplitude [a.u.]')
+
+    topomap(panel['topo'], pos, ch_names, sp2)
+    sp2.title.set_text('Topographical map')
+
+    sp3.plot(freq, panel['spectrum'])
+    sp3.title.set_text('Power spectrum')
+    sp3.set_xlabel('Frequency [Hz]')
+    sp3.set_ylabel('Power [muV^2/Hz]')
+
+    sp4.matshow(panel['matrix'], extent=[0, 1, 0, 0.8], interpolation=None, cmap='RdBu')
+    sp4.title.set_text('Time course matrix')
+    sp4.set_xlabel('Time [ms]')
+    sp4.set_ylabel('Trials')
+
+    fig.tight_layout()
+    fig.savefig(fname)
+
+    return fname
+
+
+
+def render_panels(inst, paneldir=None, n_jobs=None):
+
+    import os
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    import numpy as np
+    import TMSRepair.TMSRepair_misc as misc
+
+    if paneldir is None:
+        if inst.options['cachedir'] is not None:
+            paneldir = os.path.join(inst.options['cachedir'], 'panels')
+        else:
+            paneldir = os.path.join(tempfile.gettempdir(), 'TMSRepair_panels')
+
+    # one directory per decomposition, one file per component and class (line color)
+    paneldir = os.path.join(paneldir, panel_key(inst))
+    os.makedirs(paneldir, exist_ok=True)
+
+    ncomps = inst.options['comps']
+    fnames = [os.path.join(paneldir, 'comp{:03d}_class{}.png'.format(compnum, int(inst.compclass[compnum])))
+                for compnum in range(ncomps)]
+    missing = [compnum for compnum in range(ncomps) if not os.path.exists(fnames[compnum])]
+
+    if len(missing) > 0:
+
+        print('\nRendering {} component panels.'.format(len(missing)))
+
+        ch_names = [chan for chan in inst.epochs.ch_names 
+                    if chan in inst.options['chanpicks']]
+        freq = np.arange(   inst.options['plotfreqx'][0], 
+                            inst.options['plotfreqx'][1]+ 0.5, 0.5)
+        pos = topo_positions(ch_names)
+        sz = figure_size(inst.options)
+
+        def args(compnum):
+            return (fnames[compnum], panel_data(inst, compnum), freq, pos, ch_names, 
+                    'b' if inst.compclass[compnum] == 1 else 'r', sz)
+
+        # the panel data comes from the data in this process, only the drawing is parallel
+        if n_jobs == 1:
+            for compnum in missing:
+                render_panel(*args(compnum))
+
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                futures = [pool.submit(render_panel, *args(compnum)) for compnum in missing]
+
+                for future in futures:
+                    future.result()
+
+    # the panels of other decompositions are evicted as the decomposition cache, 
+    # least recently used first, beyond cachesize (MB)
+    os.utime(paneldir)
+    misc.cache_evict(os.path.dirname(paneldir), '[0-9a-f]'*40, inst.options['cachesize'], keep=paneldir)
+
+    return fnames
+
+
+
+def report(inst, fname, n_jobs=None, paneldir=None, title=None):
+
+    import os
+    import io
+    import json
+    import base64
+    import html
+    import numpy as np
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import TMSRepair.TMSRepair_misc as misc
+
+    def encode(png):
+        with open(png, 'rb') as file:
+            return base64.b64encode(file.read()).decode()
+
+    if title is None:
+        title = os.path.splitext(os.path.basename(fname))[0]
+
+    ncomps = inst.options['comps']
+    panelfiles = inst.render_panels(n_jobs, paneldir)
+
+    # pre/post mean over epochs for the current classification, as in ui_check
+    good = np.ones(len(inst.W), dtype=bool)
+    good[[i for i, comp in enumerate(inst.compclass) if int(comp) != 1]] = False
+
+    pre = inst.S.data_mean()
+    post = misc.project(pre[None, :, :].copy(), np.dot(inst.A[:, good], inst.W[good, :]), inst.mean)[0]
+
+    sz = figure_size(inst.options)
+    fig = check_figure(pre, post, inst.epochs.times*1000, figsize=(sz[0]/100, sz[1]/100), npix=sz[0])
+    FigureCanvasAgg(fig)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=100)
+    checkimg = base64.b64encode(buffer.getvalue()).decode()
+
+    # classification table and one section per component
+    features = [name for name in misc.feature_names if name != 'perc_var']
+    rows = []
+    sections = []
+
+    for compnum in range(ncomps):
+
+        options = ''.join(['<option value="{}"{}>{}</option>'.format(
+                                c + 1, ' selected' if int(inst.compclass[compnum]) == c + 1 else '', art) 
+                            for c, art in enumerate(art_types)])
+        select = '<select data-comp="{}">{}</select>'.format(compnum, options)
+
+        rows.append('<tr><td><a href="#comp{0}">{0}</a></td><td>{1}</td><td>{2:.2f}</td>{3}</tr>'.format(
+                    compnum, select, inst.perc_var[compnum], 
+                    ''.join(['<td>{:.3g}</td>'.format(inst.features[name][compnum]) for name in features])))
+
+        sections.append('<div id="comp{0}"><h3>Component {0}: {1}</h3><img src="data:image/png;base64,{2}"></div>'.format(
+                        compnum, art_types[int(inst.compclass[compnum]) - 1], encode(panelfiles[compnum])))
+
+    header = ''.join(['<th>{}</th>'.format(name) for name in ['component', 'class', 'perc_var'] + features])
+
+    labels = {'decomposition': misc.decomp_key(inst.W, inst.A), 'subject': title}
+
+    page = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{font-family: Helvetica, sans-serif; margin: 20px;}}
+table {{border-collapse: collapse;}}
+td, th {{border: 1px solid #ccc; padding: 2px 6px; text-align: right;}}
+img {{max-width: 100%;}}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+<h2>Pre/post correction</h2>
+<img src="data:image/png;base64,{checkimg}">
+<h2>Component classification</h2>
+<p>Change the classes and export them, to apply them in a later run with apply_labels.</p>
+<button onclick="exportLabels()">Export labels (JSON)</button>
+<table>
+<tr>{header}</tr>
+{rows}
+</table>
+<h2>Components</h2>
+{sections}
+<script>
+var labels = {labels};
+function exportLabels() {{
+    var selects = document.querySelectorAll('select[data-comp]');
+    labels.compclass = Array.from(selects).map(function (s) {{ return parseInt(s.value); }});
+    var blob = new Blob([JSON.stringify(labels, null, 4)], {{type: 'application/json'}});
+    var link = document.createElement('a');
+    link.href = URL.createObjectURL(blob);
+    link.download = labels.subject + '_labels.json';
+    link.click();
+}}
+</script>
+</body>
+</html>
+""".format( title=html.escape(title), checkimg=checkimg, header=header, 
+            rows='\n'.join(rows), sections='\n'.join(sections), labels=json.dumps(labels))
+
+    with open(fname, 'w') as file:
+        file.write(page)
+
+    return fname
+
+
+
 def ui_select(inst):
 
     import tkinter as tk
-    from mne.viz import plot_topomap
     from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
     import matplotlib.pyplot as plt
-    from scipy.stats import zscore
-    from mne.channels import read_layout
+    from concurrent.futures import ThreadPoolExecutor
     import numpy as np
 
 
     rel_time = inst.epochs.times*1000
     ch_names = [chan for chan in inst.epochs.ch_names 
                 if chan in inst.options['chanpicks']]
+    freq = np.arange(   inst.options['plotfreqx'][0], 
+                        inst.options['plotfreqx'][1]+ 0.5, 0.5)
+    ncomps = inst.options['comps']
+
+    # panels pre-rendered for this decomposition (render_panels) are only displayed
+    images = (getattr(inst, 'panelfiles', None) is not None 
+                and getattr(inst, '_panelkey', None) == panel_key(inst))
+
+    # computed once for all components
+    pos = topo_positions(ch_names)
+
+    # panel data or images of the following components are prepared in one background thread,
+    # so the lazily computed time courses are only accessed from there
+    nprefetch = 2
+    pool = ThreadPoolExecutor(max_workers=1)
+    panels = {}
+
+    def load(compnum):
+        if images:
+            return plt.imread(inst.panelfiles[compnum])
+        return panel_data(inst, compnum)
+
+    def prefetch(compnum):
+        for comp in range(compnum, min(compnum + nprefetch + 1, ncomps)):
+            if comp not in panels:
+                panels[comp] = pool.submit(load, comp)
+
+    # one window and one figure for all components, the artists are updated in place.
+    # titles, labels and frames are only drawn once into a background, 
+    # the animated artists are drawn on top of it (blitting)
+    win = ui_raw(inst.options)
+
+    if images:
+        fig = plt.figure()
+        sp = fig.add_axes([0, 0, 1, 1])
+        sp.set_axis_off()
+        png = sp.imshow(np.ones([2, 2, 3]), animated=True)
 
-    # color code for plotting (red = suspected artifact)
-    clrs = np.where(inst.compclass == 1, 'b', 'r')
-
-
-    for compnum in range(inst.options['comps']):
-
-        win = ui_raw(inst.options)
+    else:
         fig, ((sp1, sp2), (sp3, sp4)) = plt.subplots(2, 2)
 
-        temp = inst.S[compnum, :, :]
-
-        # plot time series of component
-        sp1.plot(rel_time, np.mean(temp, 1), clrs[compnum])
+        line_tc, = sp1.plot(rel_time, np.zeros(len(rel_time)), animated=True)
         sp1.title.set_text('Component time series across channels')
         sp1.set_xlabel('Time [ms]')
         sp1.set_ylabel('Amplitude [a.u.]')
 
-        # plot topographical plot
-        # adjust channel positions from default mne layout, 
-        # original from mkeute (github), plot topographical plot with mne
-        layout = read_layout("EEG1005")
-        pos = (np.asanyarray([layout.pos[layout.names.index(ch)] for ch in ch_names])[:, 0:2]- 0.5) / 5
-        plot_topomap(inst.A[:,compnum].T, pos, names=ch_names, show_names=True, axes=sp2, show=False)
+        sp2.set_axis_off()
         sp2.title.set_text('Topographical map')
-        
-        # plot spectral information
-        freq = np.arange(   inst.options['plotfreqx'][0], 
-                            inst.options['plotfreqx'][1]+ 0.5, 0.5)
-
-        if inst.options['freqscale'] == 'raw':
-            sp3.plot(freq, inst.fftbins[compnum, :].T)
-        elif inst.options['freqscale'] == 'log':
-            sp3.plot(freq, np.log(inst.fftbins[compnum, :].T))
-        elif inst.options['freqscale'] == 'log10':
-            sp3.plot(freq, np.log10(inst.fftbins[compnum, :].T))
-        elif inst.options['freqscale'] == 'db':
-            sp3.plot(freq, 10*np.log10(inst.fftbins[compnum, :].T))
 
+        line_spec, = sp3.plot(freq, np.zeros(len(freq)), animated=True)
         sp3.title.set_text('Power spectrum')
         sp3.set_xlabel('Frequency [Hz]')
         sp3.set_ylabel('Power [muV^2/Hz]')
 
-        # plot time course matrix
-        tp1 = np.argmin(np.abs(rel_time - inst.options['plottimex'][0]))
-        tp2 = np.argmin(np.abs(rel_time - inst.options['plottimex'][1]))
-        sp4.matshow(np.transpose(zscore(temp[tp1:tp2, :])), extent=[0, 1, 0, 0.8], interpolation=None, cmap='RdBu')
+        img = sp4.matshow(np.zeros([2, 2]), extent=[0, 1, 0, 0.8], interpolation=None, cmap='RdBu', animated=True)
         sp4.title.set_text('Time course matrix')
         sp4.set_xlabel('Time [ms]')
         sp4.set_ylabel('Trials')
 
+        # the amplitude axes change with each component
+        sp1.yaxis.set_animated(True)
+        sp3.yaxis.set_animated(True)
+
         plt.tight_layout()
-        canvas = FigureCanvasTkAgg(fig)
-        canvas.get_tk_widget().pack(fill=tk.BOTH, expand=tk.YES, side='bottom')
-        canvas.draw()
 
-        def on_closing():
+    canvas = FigureCanvasTkAgg(fig, master=win)
+    canvas.get_tk_widget().pack(fill=tk.BOTH, expand=tk.YES, side='bottom')
 
-            choice = clicked.get()
-            inst.compclass[compnum] = int(art_types.index(choice)) + 1
-            win.destroy()
-        
-        buttonframe = tk.Frame(win, padx=10, pady=10, bg='white')
-        buttonframe.pack(side='right')
+    dynamic = {'topo': [], 'background': None}
+
+    def draw_dynamic():
+        if images:
+            fig.draw_artist(png)
+        else:
+            for artist in [line_tc, sp1.yaxis, line_spec, sp3.yaxis, img] + dynamic['topo']:
+                fig.draw_artist(artist)
+
+    def on_draw(event):
+        # a full draw (first draw, resizing) renders the background again
+        dynamic['background'] = canvas.copy_from_bbox(fig.bbox)
+        draw_dynamic()
+
+    canvas.mpl_connect('draw_event', on_draw)
+
+    # navigation and classification
+    buttonframe = tk.Frame(win, padx=10, pady=10, bg='white')
+    buttonframe.pack(side='right')
+
+    current = {'comp': 0}
+    clicked = tk.StringVar()
+    label = tk.Label(buttonframe, bg='white')
+
+    def show(compnum):
+
+        current['comp'] = compnum
+        prefetch(compnum)
+        panel = panels[compnum].result()
+
+        if images:
+            png.set_data(panel)
+            png.set_extent([-0.5, np.shape(panel)[1] - 0.5, np.shape(panel)[0] - 0.5, -0.5])
+            sp.set_xlim(-0.5, np.shape(panel)[1] - 0.5)
+            sp.set_ylim(np.shape(panel)[0] - 0.5, -0.5)
+
+        else:
+            # color code for plotting (red = suspected artifact)
+            clr = 'b' if inst.compclass[compnum] == 1 else 'r'
+
+            line_tc.set_data(panel['time'], panel['timecourse'])
+            line_tc.set_color(clr)
+            sp1.relim()
+            sp1.autoscale_view()
+
+            # the topographical plot is redrawn with mne, using the stored positions
+            for artist in dynamic['topo']:
+                artist.remove()
+
+            before = set(sp2.get_children())
+            topomap(panel['topo'], pos, ch_names, sp2)
+            dynamic['topo'] = [artist for artist in sp2.get_children() if artist not in before]
+
+            for artist in dynamic['topo']:
+                artist.set_animated(True)
 
-        okbutton = tk.Button(buttonframe, bg='white', text='OK', command=on_closing)
-        okbutton.pack(side='right')
+            line_spec.set_ydata(panel['spectrum'])
+            sp3.relim()
+            sp3.autoscale_view()
 
-        # make a menu for choosing whether component should be rejected or not. Default should be based on threshold.
-        clicked = tk.StringVar()
+            img.set_data(panel['matrix'])
+            img.set_clim(np.nanmin(panel['matrix']), np.nanmax(panel['matrix']))
 
-        art_types = ["neural", "tms muscle artifact", 
-                    "eyeblink", "lateral eye movement", 
-                    "persistent muscle activity", "electrode noise"]
+        label.configure(text='Component {} / {}'.format(compnum + 1, ncomps))
 
         # use the classification number to index the list with the different artifact types
         # and set as default value in dropdown menu
         clicked.set(art_types[int(inst.compclass[compnum])-1])
 
-        menu = tk.OptionMenu(buttonframe, clicked, *art_types)
-        menu.configure(background='white', activebackground='white')
-        menu.pack(side='right')
+        if dynamic['background'] is None:
+            canvas.draw()
+        else:
+            canvas.restore_region(dynamic['background'])
+            draw_dynamic()
+            canvas.blit(fig.bbox)
+
+    def on_choice(*args):
+        inst.compclass[current['comp']] = int(art_types.index(clicked.get())) + 1
+
+    def on_prev(event=None):
+        if current['comp'] > 0:
+            show(current['comp'] - 1)
+
+    def on_next(event=None):
+        if current['comp'] < ncomps - 1:
+            show(current['comp'] + 1)
+        else:
+            on_closing()
+
+    def on_key(event):
+        # number keys choose the class of the current component
+        if event.char in ['1', '2', '3', '4', '5', '6']:
+            clicked.set(art_types[int(event.char) - 1])
+
+    def on_closing():
+        pool.shutdown(wait=True, cancel_futures=True)
+        win.destroy()
+
+    okbutton = tk.Button(buttonframe, bg='white', text='Done', command=on_closing)
+    okbutton.pack(side='right')
+
+    nextbutton = tk.Button(buttonframe, bg='white', text='Next >', command=on_next)
+    nextbutton.pack(side='right')
+
+    # make a menu for choosing whether component should be rejected or not. Default is based on threshold.
+    menu = tk.OptionMenu(buttonframe, clicked, *art_types)
+    menu.configure(background='white', activebackground='white')
+    menu.pack(side='right')
+
+    prevbutton = tk.Button(buttonframe, bg='white', text='< Previous', command=on_prev)
+    prevbutton.pack(side='right')
 
-        win.mainloop()
+    label.pack(side='right')
+
+    clicked.trace_add('write', on_choice)
+    win.bind('<Left>', on_prev)
+    win.bind('<Right>', on_next)
+    win.bind('<Key>', on_key)
+    win.protocol('WM_DELETE_WINDOW', on_closing)
+
+    show(0)
+
+    win.mainloop()
+    plt.close(fig)
 
 
 
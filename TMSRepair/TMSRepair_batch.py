@@ -0,0 +1,392 @@
+from TMSRepair.TMSRepair_class import TMSepochs
+import TMSRepair.TMSRepair_misc as misc
+
+import os
+import glob
+import json
+import pickle
+import itertools
+import numpy as np
+import mne
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+# thresholds that can be tuned with threshold_sweep
+thresh_names = ['tmsmusclethresh', 'blinkthresh', 'movethresh', 'musclethresh', 'elecnoisethresh']
+
+# settings that would open a UI
+headless = {'manualinput': 'off',
+            'compcheck': 'off',
+            'confirm': 'off'}
+
+art_names = ['neural', 'tms muscle artifact', 'eyeblink', 'lateral eye movement',
+             'persistent muscle activity', 'electrode noise']
+
+
+
+
+def read_epochs(fname):
+
+    """
+    Reads saved epochs, either in fif format or pickled.
+    """
+
+    if fname.endswith('.fif') or fname.endswith('.fif.gz'):
+        return mne.read_epochs(fname, preload=True, verbose=0)
+
+    with open(fname, 'rb') as file:
+        return pickle.load(file)
+
+
+
+
+def subject_name(fname):
+
+    """
+    File name without directory and epochs file extensions.
+    """
+
+    name = os.path.basename(fname)
+
+    for ext in ['.gz', '.fif', '.pkl', '.p', '-epo', '_epo']:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+
+    return name
+
+
+
+
+def rebuild_epochs(epochs):
+
+    """
+    New epochs object with the data, info, events and metadata of epochs. 
+    Epochs unpickled from other MNE versions can not always be saved directly.
+    """
+
+    return mne.EpochsArray( np.asarray(epochs._data), epochs.info, events=epochs.events, 
+                            tmin=epochs.tmin, event_id=epochs.event_id, 
+                            metadata=epochs.metadata, verbose=0)
+
+
+
+
+def summary(inst):
+
+    """
+    Summary of the component rejection of a transformed TMSepochs instance.
+
+    Args:
+        inst (TMSepochs): instance after transform_epochs_object()
+
+    Returns:
+        dict with the number of components, rank, rejected components per class,
+        and percent of the component variance removed
+    """
+
+    compclass = np.asarray(inst.compclass, dtype=int)
+
+    return {'ncomps': int(len(compclass)),
+            'rank': int(inst.rank),
+            'badcomp': [int(i) for i in inst.badcomp],
+            'compclass': compclass.tolist(),
+            'rejected': {art_names[c-1]: int(np.sum(compclass == c)) for c in range(2, 7)},
+            'perc_var_removed': float(np.sum(inst.perc_var[inst.badcomp]))}
+
+
+
+
+def process_subject(fname, outdir, options, blas_threads=None, labeldir=None, report=False):
+
+    """
+    Runs fastica, compselect, inverse_transform and transform_epochs_object
+    without any UI on one saved epochs file, and saves the repaired epochs
+    and a summary in outdir.
+
+    Args:
+        fname (str): path of the saved epochs
+        outdir (str): output directory
+        options (dict): settings for TMSepochs, UI settings are overwritten
+        blas_threads (int): maximal number of BLAS/OpenMP threads used
+        labeldir (str): directory with labels exported from reports (<subject>_labels.json),
+            which replace the classification if present. The decomposition has to be the same,
+            i.e. the same seed or a cachedir
+        report (bool): whether to write an HTML review report (<subject>_report.html)
+
+    Returns:
+        dict: summary of the subject, with the key 'error' if processing failed
+    """
+
+    from threadpoolctl import threadpool_limits
+
+    name = subject_name(fname)
+    result = {'subject': name, 'file': fname}
+
+    try:
+        with threadpool_limits(limits=blas_threads):
+
+            opts = dict(options, **headless)
+
+            inst = TMSepochs(read_epochs(fname), opts)
+            inst.fastica()
+            inst.compselect()
+
+            if labeldir is not None and os.path.exists(os.path.join(labeldir, name + '_labels.json')):
+                inst.apply_labels(os.path.join(labeldir, name + '_labels.json'))
+                result['labels'] = os.path.join(labeldir, name + '_labels.json')
+
+            if report:
+                result['report'] = inst.report(os.path.join(outdir, name + '_report.html'), n_jobs=1, title=name)
+
+            inst.inverse_transform()
+            inst.transform_epochs_object()
+
+            result['output'] = os.path.join(outdir, name + '_repaired-epo.fif')
+            rebuild_epochs(inst.epochs).save(result['output'], overwrite=True, verbose=0)
+
+            # features for later threshold tuning, see threshold_sweep
+            result['features'] = os.path.join(outdir, name + '_features.npy')
+            np.save(result['features'], inst.features)
+
+            result.update(summary(inst))
+
+    except Exception as err:
+        result['error'] = repr(err)
+
+        # no partial outputs of a failed subject
+        for key in ['report', 'output', 'features']:
+            if key in result:
+                if os.path.exists(result[key]):
+                    os.remove(result[key])
+                del result[key]
+
+    with open(os.path.join(outdir, name + '_summary.json'), 'w') as file:
+        json.dump(result, file, indent=4)
+
+    return result
+
+
+
+
+def run_batch(files, outdir, options=None, n_jobs=None, blas_threads=None, labeldir=None, report=False):
+
+    """
+    Headless processing of many subjects in parallel worker processes.
+
+    Args:
+        files (list or str): list of saved epochs files (.fif or pickled),
+            or a directory containing them (without the repaired epochs saved by run_batch)
+        outdir (str): directory for the repaired epochs and the summaries
+        options (dict): settings for TMSepochs, applied to every subject
+        n_jobs (int): number of worker processes, defaults to the number of cores
+        blas_threads (int): BLAS threads per worker, defaults to cores / n_jobs,
+            so that the cores are not oversubscribed
+        labeldir (str): directory with reviewed labels, see process_subject
+        report (bool): whether to write an HTML review report per subject.
+            Without a seed or cachedir in options, the decompositions of the reports
+            are saved in outdir/cache, where a run with labeldir and the same outdir loads them
+
+    Returns:
+        list of dicts: summary of each subject, in the order of files
+    """
+
+    if isinstance(files, str):
+        files = sorted( glob.glob(os.path.join(files, '*.fif'))
+                        + glob.glob(os.path.join(files, '*.fif.gz'))
+                        + glob.glob(os.path.join(files, '*.p'))
+                        + glob.glob(os.path.join(files, '*.pkl')))
+
+        # repaired epochs of an earlier run into the same directory
+        files = [fname for fname in files if not fname.endswith('_repaired-epo.fif')]
+
+    if options is None:
+        options = {}
+
+    # the labels only apply to the decomposition they were reviewed on, 
+    # which without a seed can only be recovered from a cache
+    if options.get('seed') is None and options.get('cachedir') is None:
+        cachedir = os.path.join(outdir, 'cache')
+
+        if labeldir is not None and not os.path.isdir(cachedir):
+            raise ValueError('Labels can only be applied to the same decomposition, '
+                             'set a seed or a cachedir, or use the outdir of the run that wrote the reports.')
+
+        if report or labeldir is not None:
+            options = dict(options, cachedir=cachedir)
+
+    ncores = os.cpu_count() or 1
+
+    if n_jobs is None:
+        n_jobs = min(ncores, max(len(files), 1))
+
+    if blas_threads is None:
+        blas_threads = max(1, ncores // n_jobs)
+
+    os.makedirs(outdir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        results = list(pool.map(process_subject, files,
+                                [outdir]*len(files),
+                                [options]*len(files),
+                                [blas_threads]*len(files),
+                                [labeldir]*len(files),
+                                [report]*len(files)))
+
+    nfailed = sum('error' in result for result in results)
+    print('\n{} subjects processed, {} failed.'.format(len(results) - nfailed, nfailed))
+
+    return results
+
+
+
+
+def threshold_sweep(subjects, grid, options=None, chunksize=1000):
+
+    """
+    Classification of the components of many decomposed subjects 
+    for every combination of threshold settings in grid, 
+    evaluated on the stored component features without recomputing them.
+
+    Args:
+        subjects (list): TMSepochs instances after fastica(), 
+            feature tables (numpy structured arrays from compute_features), 
+            or paths of features saved by run_batch. 
+            The features of rules switched off when they were computed are nan
+        grid (dict): threshold name (see thresh_names) -> list of values,
+            thresholds not in grid are taken from options
+        options (dict): settings for the on/off switches and the remaining thresholds,
+            defaults to the TMSepochs defaults
+        chunksize (int): number of settings classified at once, bounds the memory used
+
+    Returns:
+        dict with
+            'settings': list of dicts, the threshold values of each setting
+            'counts': numpy array (settings, subjects, 6) with the number of components per class,
+                (neural, tms muscle, eyeblink, lateral eye movement, persistent muscle, electrode noise)
+            'perc_var_removed': numpy array (settings, subjects), 
+                percent of variance of the rejected components
+    """
+
+    for name in grid:
+        if name not in thresh_names:
+            raise ValueError('{} is not a threshold that can be swept, choose from {}'.format(name, thresh_names))
+
+    opts = dict(TMSepochs.options, **(options or {}))
+
+    # all components of all subjects in one table
+    features = []
+    for subject in subjects:
+        if isinstance(subject, TMSepochs):
+            features.append(subject.compute_features())
+        elif isinstance(subject, str):
+            features.append(np.load(subject))
+        else:
+            features.append(np.asarray(subject))
+
+    subjidx = np.repeat(np.arange(len(features)), [len(feat) for feat in features])
+    features = np.concatenate(features)
+
+    names = list(grid)
+    settings = [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+    nsubj = len(subjects)
+    counts = np.zeros([len(settings), nsubj, 6], dtype=int)
+    perc_var_removed = np.zeros([len(settings), nsubj])
+
+    for sl in misc.chunks(len(settings), chunksize):
+
+        # one column of thresholds per setting, broadcasting against the components
+        thresh = {name: np.array([setting[name] for setting in settings[sl]])[:, None] for name in names}
+        nset = len(settings[sl])
+        compclass = misc.classify(features, dict(opts, **thresh)).astype(int)
+        compclass = np.broadcast_to(compclass, (nset, len(features)))
+
+        # count per setting, subject and class in one bincount
+        flat = (np.arange(nset)[:, None]*nsubj + subjidx)*6 + compclass - 1
+        counts[sl] = np.bincount(flat.ravel(), minlength=nset*nsubj*6).reshape(nset, nsubj, 6)
+
+        flat = np.arange(nset)[:, None]*nsubj + subjidx
+        removed = np.where(compclass != 1, features['perc_var'], 0)
+        perc_var_removed[sl] = np.bincount(flat.ravel(), removed.ravel(), minlength=nset*nsubj).reshape(nset, nsubj)
+
+    return {'settings': settings, 'counts': counts, 'perc_var_removed': perc_var_removed}
+
+
+
+
+def train_classifier(subjects, fname):
+
+    """
+    Trains the component classifier on the reviewed classes (compclass)
+    of decomposed subjects and saves it, to be used with the option classifier
+    or classify_batch. All subjects need the same chanpicks and plotfreqx.
+
+    Args:
+        subjects (list): TMSepochs instances after compselect() and review
+        fname (str): path the classifier is saved to
+
+    Returns:
+        sklearn pipeline: the fitted model
+    """
+
+    chanpicks, plotfreqx = check_subjects(subjects)
+
+    vectors = np.concatenate([misc.comp_vectors(subject) for subject in subjects])
+    labels = np.concatenate([subject.compclass for subject in subjects])
+
+    model = misc.classifier_fit(vectors, labels)
+    misc.classifier_save(fname, model, chanpicks, plotfreqx)
+
+    return model
+
+
+
+
+def classify_batch(subjects, fname):
+
+    """
+    Classifies the components of many decomposed subjects with a saved classifier
+    in one call, and stores the classes in compclass of each subject.
+
+    Args:
+        subjects (list): TMSepochs instances after fastica()
+        fname (str): path of a classifier saved by train_classifier
+
+    Returns:
+        list of numpy arrays: classes of the components of each subject
+    """
+
+    chanpicks, plotfreqx = check_subjects(subjects)
+
+    for subject in subjects:
+        subject.compute_features()
+
+    vectors = [misc.comp_vectors(subject) for subject in subjects]
+    compclass = misc.classifier_predict(misc.classifier_load(fname), np.concatenate(vectors), chanpicks, plotfreqx)
+
+    compclass = np.split(compclass, np.cumsum([len(vec) for vec in vectors])[:-1])
+
+    for subject, classes in zip(subjects, compclass):
+        subject.compclass = classes
+
+    return compclass
+
+
+
+
+def check_subjects(subjects):
+
+    """
+    Channels and frequency range shared by all subjects, 
+    raises a ValueError if they differ.
+    """
+
+    chanpicks = subjects[0].options['chanpicks']
+    plotfreqx = subjects[0].options['plotfreqx']
+
+    for subject in subjects:
+        if subject.options['chanpicks'] != chanpicks or subject.options['plotfreqx'] != plotfreqx:
+            raise ValueError('All subjects need the same chanpicks and plotfreqx for the classifier.')
+
+    return chanpicks, plotfreqx
@@ -3,11 +3,9 @@ import TMSRepair.TMSRepair_UIs as UIs
 
 import numpy as np
 import matplotlib
-import mne
 
-from copy import copy
+from copy import deepcopy
 from sklearn.decomposition import FastICA
-from scipy.stats import zscore
 
 
 
@@ -23,17 +21,26 @@ class TMSepochs:
     epochs : mne epochs object
         data to be repaired in mne format
     options : dict
-        dictionary with the settings for the ICA. 
+        dictionary with the settings for the ICA, copied from the class defaults
+        for each instance
+    config : tuple
+        hashable, immutable snapshot of the validated options
     rank : int
-        rank of the matrix that the ICA is performed on
+        rank of the matrix that the ICA is performed on, 
+        i.e. the number of principal components kept (options pcacomps, pcavar)
     orig_backend : string
         original backend at the timepoint the object is initialized. 
         The backend needs to be changed to 'Agg' for tkinter 
         and later be reset.
-    S : numpy array
-        ICA components time courses
+    S : misc.Sources
+        ICA components time courses (components*timepoints*epochs), 
+        computed lazily from the unmixing matrix and the epochs data
     A : numpy array
         mixing matrix
+    W : numpy array
+        unmixing matrix, applied to the data after subtracting mean
+    K, Kinv : numpy array
+        PCA whitening matrix the ICA was fitted on and its pseudo-inverse
     badcomp : list
         the components that were chosen to be rejected
     compclass : list
@@ -41,15 +48,25 @@ class TMSepochs:
         indicating the class of the component
     fftbins : numpy array
         spectral information of each component
+    features : numpy structured array
+        artifact features of each component (see misc.feature_names), 
+        computed once per decomposition and used for the classification
     mean : numpy array
         mean for each channel that was subtracted from the data for whitening it prior to ICA, 
         that needs to be added after the inverse transform  
     perc_var : array
         percent of amplitude variance relative to other components over time 
         for each component
+    proj : numpy array
+        projection of the picked channels that removes the rejected components
     post : numpy array
         data after the inverse transform, stored separately
-        in order not to replace it in the epochs object right away
+        in order not to replace it in the epochs object right away.
+        Not built with the option inplace, where the projection is applied
+        block-wise to the epochs object in transform_epochs_object
+    repaired : numpy array
+        boolean mask of the timepoints replaced with zeros or interpolated,
+        which are left out when fitting the ICA
     transformed : bool
         whether the data in the epochs object has already been transformed 
         and the matrix rank adjusted to the component rejection
@@ -57,26 +74,73 @@ class TMSepochs:
 
     Methods
     ----------
+    to_memmap(fname : str):
+        stream the epochs data block-wise into a memory-mapped file, 
+        so that it does not need to fit into memory
     mark_bad_channels:
         interactive rejection of bad channels specifically for analyzing event-related potentials.
         plots channel variance and the event related potentials 
         averaged across epochs for bad channel marking.
-    replace_with_zeros(window : list):
+    replace_with_zeros(window : list, pulses : list):
         removes the data in each epoch 
-        in the specified window [ms, e.g. [-5, 15]] and replaces it with zeros
-    cubic_interpolation(window : list):
+        in the specified window [ms, e.g. [-5, 15]] and replaces it with zeros.
+        A list of windows [[-5, 15], [95, 115]] can be given, or the window can be 
+        repeated relative to each pulse time in pulses [ms, e.g. [0, 100]]
+    cubic_interpolation(window : list, support : list, pulses : list):
         interpolates the data in each epoch 
-        in the specified window with first degree cubic interpolation
-    fastica:
-        performs fast ICA and sorts components after their variance over time
+        in the specified window(s) with first degree cubic interpolation.
+        If support [ms before, ms after] is given, only the data in this 
+        neighbourhood of the window is used for the fit (as in TESA)
+    fastica(warm_start : bool):
+        performs fast ICA and sorts components after their variance over time.
+        With warm_start, the previous decomposition of the same channels is refined
+        instead of starting from a random unmixing matrix.
+        With the options fit_decim and fit_fraction, the unmixing is estimated on 
+        a decimated and/or randomly subsampled part of the samples only.
+        With the options pcacomps (number) or pcavar (fraction of variance),
+        the data is compressed to its first principal components before the ICA,
+        the variance of the discarded components is not reconstructed.
+        Timepoints repaired with replace_with_zeros or cubic_interpolation 
+        are left out of the fit, the unmixing is still applied to them
+    compute_features:
+        artifact features of each component (self.features), only recomputed 
+        after a new decomposition, if the feature settings changed or if a rule was switched on.
+        Features of the rules that are switched off are nan
+    compute_spectra:
+        binned power spectrum of each component (self.fftbins), only computed 
+        when needed and recomputed after a new decomposition or if comps or plotfreqx changed
     compselect:
-        component classification based on thresholds and/or visual inspection
+        component classification based on thresholds and/or visual inspection.
+        Changing only thresholds re-classifies from the stored features.
+        With the option classifier (path of a classifier saved by 
+        TMSRepair_batch.train_classifier), the classes are predicted by it instead
+    render_panels(n_jobs : int, paneldir : str):
+        renders the review panels of all components in parallel processes to PNG files 
+        (self.panelfiles), in a directory per decomposition under paneldir 
+        (default: cachedir/panels or the temporary directory). 
+        Already rendered panels are reused. ui_select then only displays the images,
+        with the option prerender this is done in compselect before the UI opens
+    report(fname : str, n_jobs : int, paneldir : str, title : str):
+        writes a self-contained HTML file with the pre/post plot of ui_check, 
+        the classification table and the panels of all components, 
+        for review without a display. The classes can be changed there and 
+        exported as JSON
+    apply_labels(fname : str):
+        sets compclass from labels exported from a report of the same decomposition
     inverse_transform:
         application of the inverse transform, rejection of artifactual components,
         optionally visual check. 
         Result is saved in self.post (data in epochs not changed)
+        or only as projection self.proj with the option inplace.
+        If only some component labels changed since the last call, 
+        only these components are added or subtracted
     transform_epochs_object:
-        replace epochs._data with the transformed data
+        write the transformed data into epochs._data, block by block. 
+        The time courses of the rejected components are kept, so that 
+        inverse_transform can still restore them until the data is changed otherwise
+    data_changed:
+        drops the component time courses, features and reconstruction computed from 
+        epochs._data, called by the methods that change it
     reset_orig_backend:
         reset the matplotlib backend after setting it to 'Agg' for tkinter
     fit_select_transform:
@@ -93,11 +157,15 @@ class TMSepochs:
                 'chanpicks':[],
                 'compcheck':'on',
                 'remove':'on', 
+                'inplace':'off',
                 'comps': -1, 
                 'figsize': 'medium', 
                 'plottimex': [-200, 300], 
                 'plotfreqx': [1,100],
                 'freqscale': 'log',
+                'prerender': 'off',
+                'chunksize': None,
+                'dtype': 'float64',
                 
                 'tmsmuscle': 'on',
                 'tmsmusclethresh': 8,
@@ -105,6 +173,13 @@ class TMSepochs:
 
                 'approach': 'parallel', 
                 'g': 'logcosh', 
+                'seed': None,
+                'pcacomps': None,
+                'pcavar': None,
+                'fit_decim': 1,
+                'fit_fraction': 1,
+                'cachedir': None,
+                'cachesize': 500,
 
                 'blink':'on', 
                 'blinkthresh':2.5, 
@@ -120,7 +195,9 @@ class TMSepochs:
                 'musclefreqex':[48, 52],
                 
                 'elecnoise':'on',
-                'elecnoisethresh':2}
+                'elecnoisethresh':2,
+
+                'classifier': None}
 
 
 
@@ -128,9 +205,15 @@ class TMSepochs:
     def __init__(self, epochs, options=None):
 
         self.epochs = epochs
-        self.options['chanpicks'] = [self.epochs.ch_names[i] for i in self.epochs.picks]
         self.orig_backend = matplotlib.get_backend()
 
+        # timepoints replaced with zeros or interpolated, left out of the ICA fit
+        self.repaired = np.zeros(len(self.epochs.times), dtype=bool)
+
+        # every instance works on its own copy of the default options
+        self.options = deepcopy(type(self).options)
+        self.options['chanpicks'] = [self.epochs.ch_names[i] for i in self.epochs.picks]
+
         # overwrite default options with user choices and check them
         if options is not None:
             self.set_options(options)
@@ -142,32 +225,86 @@ class TMSepochs:
 
     def set_options(self, options):
 
+        comps = self.options['comps']
         self.options = misc.eval_param(self.options, options)  
 
         # if manual input desired open UI
         if self.options['manualinput'] == 'on':
             self.options = UIs.ui_input(self.options)
 
+        # keep the number of components as requested, 
+        # options['comps'] is limited to the rank of each decomposition in fastica
+        if ('comps' in [opt.lower() for opt in options] or self.options['comps'] != comps 
+                or not hasattr(self, '_comps')):
+            self._comps = self.options['comps']
+
         # check if parameters are valid
         misc.check_param(self)
 
 
 
-    def replace_with_zeros(self, win:list):
+
+    @property
+    def config(self):
+
+        return misc.freeze_param(self.options)
+
+
+
+    def replace_with_zeros(self, win:list, pulses:list=None):
         
-        # convert window to indices in epochs, +1 to include last timepoint
-        idx1 = np.argmin(np.abs(self.epochs.times - win[0]*0.001))
-        idx2 = np.argmin(np.abs(self.epochs.times - win[1]*0.001)) +1
+        # convert window(s) to one mask over the timepoints of the epochs
+        mask = misc.win_to_mask(self.epochs.times, win, pulses)
+
+        # set values in specified window(s) to 0, one block of epochs at a time
+        for sl in misc.chunks(len(self.epochs._data), self.options['chunksize']):
+            self.epochs._data[sl, :, mask] = 0
+
+        if isinstance(self.epochs._data, np.memmap):
+            self.epochs._data.flush()
+
+        self.repaired |= mask
+        self.data_changed()
+
+
+
+
+    def cubic_interpolation(self, win:list, support:list=None, pulses:list=None):
+
+        self.epochs = misc.cubic_interpolation( self.epochs, win, support, pulses, 
+                                                self.options['chunksize'])
+
+        self.repaired |= misc.win_to_mask(self.epochs.times, win, pulses)
+        self.data_changed()
+
+
+
+
+    def to_memmap(self, fname:str):
+
+        data = self.epochs._data if self.epochs.preload else None
+        self.epochs = misc.memmap_epochs(self.epochs, fname, self.options['chunksize'])
+
+        # the components of the same values are now computed from the file
+        if hasattr(self, 'S') and self.S.data is data:
+            self.S.data = self.epochs._data
 
-        # set values in specified window to 0
-        self.epochs._data[:, :, idx1:idx2] = 0
 
 
 
+    def data_changed(self):
 
-    def cubic_interpolation(self, win:list):
+        # time courses, features and reconstructions computed from the previous values are outdated,
+        # and components removed by transform_epochs_object can no longer be restored
+        if hasattr(self, 'S'):
+            self.S.clear()
+            self.S.removed = None
 
-        self.epochs = misc.cubic_interpolation(self.epochs, win)
+        self._featkey = None
+        self._speckey = None
+        self._good = None
+        if hasattr(self, 'post'):
+            del self.post
 
 
 
@@ -178,31 +315,20 @@ class TMSepochs:
         vars = np.var(self.epochs._data.T, axis=(0,2))
         badchans = misc.chan_visual_inspection(vars)
 
-        # filtering and plotting of epochs data with marked bad channels
-        # bandpass and bandstop filter data first
-        epochs = copy(self.epochs)
-       
-        # mark the channels with high variance
-        epochs.info['bads'] = [epochs.info['ch_names'][i] for i in list(badchans)]
-
-        # interpolate, bandpass and bandstop filter data
-        # this is done only on the copied epochs object within the scope of this function, 
-        # only for visualization and noisy channel detection!
-        epochs = misc.cubic_interpolation(epochs, [-5, 15])
-        epochs.filter(0.5, 49, method='iir', verbose=0)
-        epochs._data = mne.filter.notch_filter( epochs._data, epochs.info['sfreq'], 50, notch_widths=2, 
-                                                phase='zero', verbose=0)
+        # interpolated, bandpass and bandstop filtered evoked response,
+        # only for visualization and noisy channel detection (the epochs are not changed)
+        erp = misc.erp_preview(self.epochs, [-5, 15], self.options['chunksize'])
 
-        # create a fake raw object out of the evoked object, 
+        # create a fake raw object out of the evoked response, 
         # to see which channels distort the ERP and be able to mark them
-        evoked = epochs.average()
-        fake_raw = misc.MNE_raw_format( evoked._data.T, 
-                                        epochs.info['ch_names'], 
-                                        epochs.info['sfreq'])
+        fake_raw = misc.MNE_raw_format( erp.T, 
+                                        self.epochs.info['ch_names'], 
+                                        self.epochs.info['sfreq'])
 
-        fake_raw.info['bads'] = epochs.info['bads']
+        # mark the channels with high variance
+        fake_raw.info['bads'] = [self.epochs.info['ch_names'][i] for i in list(badchans)]
 
-        fake_raw.plot(  n_channels=len(epochs.info['ch_names']), scalings='auto', 
+        fake_raw.plot(  n_channels=len(self.epochs.info['ch_names']), scalings='auto', 
                         title='EEG data - Choose bad channels manually', 
                         show=True,
                         bad_color='r',
@@ -220,188 +346,318 @@ class TMSepochs:
 
 
 
-    def fastica(self):
+    def fastica(self, warm_start:bool=False):
 
         ch_idx = [ i for i, chan in enumerate(self.epochs.ch_names) 
                         if chan in self.options['chanpicks']]
 
         # reconcatenate epochs
-        nevents, nchans, npnts = np.shape(self.epochs._data[:, ch_idx, :])
-        data_concat = np.reshape(np.moveaxis(self.epochs._data[:, ch_idx, :], 0, 2), [nchans, -1])
+        nevents, _, npnts = np.shape(self.epochs._data)
 
-        print('\nPerforming fast ICA on data using {} approach.'
-                .format(self.options['approach']))
+        # the ICA is fitted on every fit_decim-th timepoint, leaving out repaired (flat or 
+        # interpolated) timepoints, which carry no independent information
+        repaired = getattr(self, 'repaired', np.zeros(npnts, dtype=bool))
+        if len(repaired) != npnts:
+            repaired = np.zeros(npnts, dtype=bool)
 
-        # check whether matrix is full rank, or adjust the number of components
-        # otherwise fast ICA may fail to converge because it is searching for more ICs 
-        # than there are in the data
-        self.rank = np.linalg.matrix_rank(data_concat)
+        if np.all(repaired):
+            raise ValueError('All timepoints were repaired, there is no data left to fit the ICA on.')
 
-        if self.rank < self.options['comps']:
-            print('The matrix rank is {}. '. format(self.rank))
-            print('Number of components adjusted accordingly.')
-            self.options['comps'] = self.rank
+        covidx = np.flatnonzero(~repaired)
+        fitidx = np.arange(0, npnts, self.options['fit_decim'])
+        fitidx = fitidx[~repaired[fitidx]]
 
+        # look for a decomposition of the same data with the same ICA settings
+        if self.options['cachedir'] is not None:
+            key = misc.ica_key(self.epochs._data, ch_idx, self.options, covidx)
+            cached = misc.cache_load(self.options['cachedir'], key)
+        else:
+            cached = None
 
-        # run FastICA and reshape component time courses
-        ica = FastICA(  n_components=self.rank, 
-                        algorithm=self.options['approach'], 
-                        fun=self.options['g'], 
-                        max_iter=1000)
+        dtype = self.options['dtype']
 
-        ica = ica.fit(data_concat.T)
-        icasig = ica.transform(data_concat.T)
+        if cached is not None:
 
-        self.S = np.reshape(icasig.T, [-1, npnts, nevents]) # component 3d time courses
-        self.A = ica.mixing_ # topographies
-        self.mean = ica.mean_ # mean for the inverse transform of the whitened data
+            print('\nFast ICA decomposition loaded from cache.')
 
-        # get variance of each component in percent relative to all components as mean over epochs
-        vars = np.var(np.mean(self.S, 2), axis=1)
-        self.perc_var =  vars/sum(vars)*100
+            self.rank = int(cached['rank'])
+            self.mean = cached['mean']
+            self.W = cached['W']
+            self.A = cached['A']
+            self.perc_var = cached['perc_var']
+            self.K = cached['K']
+            self.Kinv = cached['Kinv']
 
-        # sort components in descending order based on variance
-        ixsSort = np.flip(np.argsort(self.perc_var))
+        else:
 
-        self.perc_var = self.perc_var[ixsSort]
-        self.A = self.A[:, ixsSort]
-        self.S = self.S[ixsSort, :,:]
+            # warm start from the previous decomposition of the same channels,
+            # reusing its whitening and starting from its unmixing matrix
+            warm = (warm_start and hasattr(self, 'W') and not getattr(self, 'transformed', False)
+                    and self._fitpicks == self.options['chanpicks'] and self.rank == len(self.K)
+                    and np.array_equal(self._fitidx, covidx)
+                    and self._fitpca == (self.options['pcacomps'], self.options['pcavar']))
 
-        print('\nICA weights sorted by time course variance.')
+            print('\nPerforming fast ICA on data using {} approach{}.'
+                    .format(self.options['approach'], 
+                            ', starting from the previous decomposition' if warm else ''))
 
+            if warm:
+                w_init = np.dot(self.W, self.Kinv)
 
+            else:
+                # check whether matrix is full rank, or adjust the number of components
+                # otherwise fast ICA may fail to converge because it is searching for more ICs 
+                # than there are in the data.
+                # the rank and the PCA whitening both come from one eigendecomposition 
+                # of the channel covariance, instead of an SVD of the concatenated data
+                self.mean, cov, n = misc.data_cov(self.epochs._data, ch_idx, self.options['chunksize'], covidx)
+                self.rank, eigval, eigvec = misc.pca(cov, n)
+
+                # optionally the ICA is only performed on the first principal components
+                ncomps = misc.pca_ncomps(eigval, self.rank, self.options['pcacomps'], self.options['pcavar'])
+
+                if ncomps < self.rank:
+                    print('\nData compressed to {} principal components ({:.1f} % of the variance).'
+                            .format(ncomps, np.sum(eigval[:ncomps])/np.sum(eigval[:self.rank])*100))
+                    self.rank = ncomps
+
+                self.K, self.Kinv = misc.whitening(eigval, eigvec, self.rank)
+                w_init = None
+
+            # the unmixing is estimated on the fit timepoints 
+            # and a random fit_fraction of their samples, and applied to all samples.
+            # the samples are drawn first, so that only they are gathered from the data
+            if self.options['fit_fraction'] < 1:
+                cols = misc.sample_columns( len(fitidx)*nevents, self.options['fit_fraction'], 
+                                            self.options['seed'])
+            else:
+                cols = None
 
+            data_concat = misc.concat_epochs(   self.epochs._data, ch_idx, dtype, 
+                                                self.options['chunksize'], fitidx, cols)
 
-    def compselect(self):
+            if np.shape(data_concat)[1] < npnts*nevents:
+                print('Fitting on {} of {} samples.'.format(np.shape(data_concat)[1], npnts*nevents))
 
-        # create zscore for each component across channels
-        tempCompZ = zscore(self.A, 0)
+            data_concat -= self.mean[:, None].astype(dtype)
 
-        # tms muscle window
-        if self.options['tmsmuscle'] == 'on':
-            mt1 = np.argmin(np.abs(self.epochs.times*1000 - self.options['tmsmusclewin'][0]))
-            mt2 = np.argmin(np.abs(self.epochs.times*1000 - self.options['tmsmusclewin'][1]))
+            # run FastICA on the whitened data
+            ica = FastICA(  whiten=False,
+                            algorithm=self.options['approach'], 
+                            fun=self.options['g'], 
+                            max_iter=1000,
+                            w_init=w_init,
+                            random_state=self.options['seed'])
 
-            muscleScore = np.abs(np.mean(self.S, 2))
-            winScore = np.mean(muscleScore[:, mt1:mt2], 1)
-            tmsmuscleratio = winScore / np.mean(muscleScore)
+            ica = ica.fit(np.dot(self.K.astype(dtype), data_concat).T)
+            del data_concat
 
-        # eyeblinks
-        if self.options['blink'] == 'on':
-            blinkidx = [i for i, chan in enumerate(self.options['chanpicks']) if chan in self.options['blinkelecs']]
-            blinkratio = np.mean(tempCompZ[blinkidx, :], 0)
+            erp = misc.data_mean(self.epochs._data, ch_idx, self.options['chunksize'])
 
-        # lateral eye movements
-        if self.options['move'] == 'on':
-            moveidx = [i for i, chan in enumerate(self.options['chanpicks']) if chan in self.options['moveelecs']]
-            moveval = np.transpose(tempCompZ[moveidx,:])
+            self.W = np.dot(ica.components_, self.K) # unmixing matrix for the centered data
+            self.A = np.dot(self.Kinv, np.linalg.pinv(ica.components_)) # topographies
 
-        # electrode noise
-        if self.options['elecnoise'] == 'on':
-            elecnoise = np.amax(np.abs(tempCompZ), axis=0)
+            # get variance of each component in percent relative to all components as mean over epochs,
+            # the mean over epochs of the component time courses is the unmixed mean over epochs of the data
+            vars = np.var(np.dot(self.W, erp), axis=1)
+            self.perc_var =  vars/sum(vars)*100
 
-        # get indices for frequency range to detect persistent muscle activity
-        freq = np.arange(self.options['plotfreqx'][0], self.options['plotfreqx'][1]+ 0.5, 0.5)
+            # sort components in descending order based on variance
+            ixsSort = np.flip(np.argsort(self.perc_var))
 
-        # if needed for muscle activity detection or component inspection, calculate frequency spectrum
-        if self.options['muscle'] == 'on' or self.options['compcheck'] == 'on':
+            self.perc_var = self.perc_var[ixsSort]
+            self.A = self.A[:, ixsSort]
+            self.W = self.W[ixsSort, :]
 
-            sfreq = self.epochs.info['sfreq']
-            _, L, n_epoch = np.shape(self.S)
+            print('\nICA weights sorted by time course variance.')
 
-            # find the next power of 2 from the length of Y
-            NFFT = 2**np.ceil(np.log2(abs(L)))
-            f = sfreq/2 * np.linspace(0, 1, int(NFFT/2+1))
-            freq = np.arange(self.options['plotfreqx'][0], self.options['plotfreqx'][1]+ 0.5, 0.5)
+            if self.options['cachedir'] is not None:
+                misc.cache_save(self.options['cachedir'], key, self.options['cachesize'], 
+                                rank=self.rank, mean=self.mean, W=self.W, A=self.A, 
+                                perc_var=self.perc_var, order=ixsSort, K=self.K, Kinv=self.Kinv)
 
-            Y2 = np.zeros([self.options['comps'], len(freq), n_epoch])
+        # the requested number of components, limited by the rank of this decomposition
+        comps = len(self.options['chanpicks'])
+        if self._comps != -1:
+            comps = min(self._comps, comps)
 
-            # get the spectral information of each component of interest
-            Y = np.fft.rfft(zscore(self.S, axis=1)[:self.options['comps'],:,:], n=int(NFFT), axis=1)/L
-            Yout = np.abs(Y)**2
+        if self.rank < comps:
+            print('The matrix rank is {}. '. format(self.rank))
+            print('Number of components adjusted accordingly.')
 
-            # create frequency bins of 0.5 Hz in width centered around whole frequencies 
-            for ia, a in enumerate(freq):
-                index1 = np.argmin(np.abs(f-(a-0.25)))
-                index2 = np.argmin(np.abs(f-(a+0.25)))
-                Y2[:, ia, :] = np.mean(Yout[:, index1:index2,:], 1)
+        self.options['comps'] = min(comps, self.rank)
 
-            self.fftbins = np.mean(Y2, 2)
+        self._fitpicks = list(self.options['chanpicks'])
+        self._fitidx = covidx
+        self._fitpca = (self.options['pcacomps'], self.options['pcavar'])
 
-        
-        if self.options['muscle'] == 'on':
+        # a new decomposition needs new features and a new reconstruction
+        self._featkey = None
+        self._speckey = None
+        self._good = None
+        for attr in ['proj', 'post', 'panelfiles']:
+            if hasattr(self, attr):
+                delattr(self, attr)
 
-            # frequencies to include into fit
-            if len(self.options['musclefreqin']) != 0:
-                fin1 = np.argmin(np.abs(freq-self.options['musclefreqin'][0]))
-                fin2 = np.argmin(np.abs(freq-self.options['musclefreqin'][1]))
-                freqHz = freq[fin1:fin2]
-            else:
-                freqHz = freq
+        # component 3d time courses, in sorted order, computed from the data when needed
+        self.S = misc.Sources(  self.epochs._data, ch_idx, self.W, self.mean, 
+                                dtype, self.options['chunksize'])
 
-            # frequencies to exclude from fit
-            if len(self.options['musclefreqex']) != 0:
-                fex1 = np.argmin(np.abs(freqHz-self.options['musclefreqex'][0]))
-                fex2 = np.argmin(np.abs(freqHz-self.options['musclefreqex'][1]))
-                np.delete(freqHz, slice(fex1, fex2))
-            
-            # get idx of frequencies in power spectrum
-            musclefidx = [i for i, f in enumerate(freq) if f in freqHz]
 
-            # polynomial fit for each component, store the slope
-            freqPow = self.fftbins[:, musclefidx]
-            p = np.polyfit(np.log(freqHz), np.log(freqPow).T, 1)
-            muscleratio = p[0,:]
 
-        # create output storage
-        self.compclass = np.zeros([self.options['comps']])
 
-        # select if component is artifact
-        print('\nClassifying components.')
+    def compute_features(self):
 
-        for compnum in range(self.options['comps']):
+        # the artifact features of each component only depend on the decomposition
+        # and the feature settings, not on the thresholds, so they are only recomputed if those changed
+        featkey = misc.freeze_param({opt: self.options[opt] for opt in misc.feature_opts})
 
-            if self.options['tmsmuscle'] == 'on' and tmsmuscleratio[compnum] >= self.options['tmsmusclethresh']:
-                self.compclass[compnum] = 2
+        # features of rules switched off are not computed, so switching a rule on also needs new features
+        rules = {rule for rule in misc.feature_rules if self.options[rule] == 'on'}
 
-            elif self.options['blink'] == 'on' and np.abs(blinkratio[compnum]) >= self.options['blinkthresh']:
-                self.compclass[compnum] = 3
+        if getattr(self, '_featkey', None) != featkey or not rules <= self._featrules:
+            self.features = misc.comp_features(self)
+            self._featkey = featkey
+            self._featrules = rules
 
-            elif self.options['move'] == 'on' and moveval[compnum, 0] >= self.options['movethresh'] and moveval[compnum, 1] <= -self.options['movethresh']  \
-                or  self.options['move'] == 'on' and moveval[compnum, 1] >= self.options['movethresh']  and moveval[compnum, 0] <= -self.options['movethresh'] :
-                self.compclass[compnum] = 4
+        return self.features
 
-            elif self.options['muscle'] == 'on' and muscleratio[compnum] >= self.options['musclethresh']:
-                self.compclass[compnum] = 5
 
-            elif self.options['elecnoise'] == 'on' and elecnoise[compnum] >= np.abs(self.options['elecnoisethresh']):
-                self.compclass[compnum] = 6
 
-            else:
-                self.compclass[compnum] = 1
 
+    def compute_spectra(self):
+
+        # mean power in frequency bins of 0.5 Hz in width centered around whole frequencies,
+        # accumulated over blocks of epochs.
+        # only computed when needed (muscle activity detection, component inspection, classifier)
+        speckey = misc.freeze_param({opt: self.options[opt] for opt in ['comps', 'plotfreqx']})
+
+        if getattr(self, '_speckey', None) != speckey:
+            self.fftbins = misc.component_spectra( self.S, self.epochs.info['sfreq'], 
+                                                    self.options['plotfreqx'], range(self.options['comps']))
+            self._speckey = speckey
+
+        return self.fftbins
+
+
+
+
+    def compselect(self):
+
+        self.compute_features()
+
+        # select if component is artifact
+        print('\nClassifying components.')
+
+        if self.options['classifier'] is None:
+            self.compclass = misc.classify(self.features, self.options)
+        else:
+            self.compclass = misc.classifier_predict(   misc.classifier_load(self.options['classifier']), 
+                                                        misc.comp_vectors(self), 
+                                                        self.options['chanpicks'], self.options['plotfreqx'])
 
         # if desired, open UI for a manual check of the components
         if self.options['compcheck'] == 'on':
+            self.compute_spectra()
+            if self.options['prerender'] == 'on':
+                self.render_panels()
             UIs.ui_select(self)
 
+
+
+
+    def render_panels(self, n_jobs:int=None, paneldir:str=None):
+
+        self.compute_spectra()
+        self.panelfiles = UIs.render_panels(self, paneldir, n_jobs)
+        self._panelkey = UIs.panel_key(self)
+
+        return self.panelfiles
+
+
+
+
+    def report(self, fname:str, n_jobs:int=None, paneldir:str=None, title:str=None):
+
+        return UIs.report(self, fname, n_jobs, paneldir, title)
+
+
+
+
+    def apply_labels(self, fname:str):
+
+        import json
+
+        with open(fname) as file:
+            labels = json.load(file)
+
+        # the labels are only valid for the decomposition they were made for
+        if labels['decomposition'] != misc.decomp_key(self.W, self.A):
+            raise ValueError('The labels in {} were made for a different decomposition.'.format(fname))
+
+        if len(labels['compclass']) != self.options['comps']:
+            raise ValueError('The labels in {} are for {} components, not {}.'
+                                .format(fname, len(labels['compclass']), self.options['comps']))
+
+        self.compclass = np.asarray(labels['compclass'], dtype=np.float64)
+
     
 
 
     def inverse_transform(self):
 
         self.badcomp = [i for i, comp in enumerate(self.compclass) if int(comp) != 1]
-        goodcomp = [i for i in range(self.rank) if i not in self.badcomp]
 
-        # correcting data by removing the detected artifactual components
-        # dot product between the component time series and the transpose of the mixing matrix
-        # mean added because data was whitened prior to ICA
-        ncomps, npnts, nevents = np.shape(self.S)
-        
-        S_concat = np.reshape(self.S, [ncomps, -1])
-        post = np.dot(S_concat[goodcomp,:].T, self.A[:,goodcomp].T)
-        post += self.mean
-        self.post = np.reshape(post.T, [len(self.options['chanpicks']), npnts, nevents])
+        good = np.ones(len(self.W), dtype=bool)
+        good[self.badcomp] = False
+        goodcomp = np.flatnonzero(good)
+
+        dtype = self.options['dtype']
+
+        nevents = self.S.shape[2]
+
+        # if only some labels changed since the last reconstruction of the same decomposition,
+        # add or subtract these components (one outer product each) instead of starting over
+        incremental = ( getattr(self, '_good', None) is not None 
+                        and not getattr(self, 'transformed', False)
+                        and (self.options['inplace'] == 'on' 
+                            or hasattr(self, 'post') and self.post.dtype == dtype))
+
+        if incremental:
+
+            for comp in np.flatnonzero(good != self._good):
+
+                sign = 1 if good[comp] else -1
+                self.proj += sign * np.outer(self.A[:, comp], self.W[comp, :])
+
+                if self.options['inplace'] == 'off':
+                    Acomp = sign * self.A[:, comp].astype(dtype)
+                    for sl in misc.chunks(nevents, self.options['chunksize']):
+                        self.post[:, :, sl] += np.multiply.outer(Acomp, self.S[comp][:, sl])
+
+        else:
+
+            # correcting data by removing the detected artifactual components.
+            # the good components are unmixed from the centered data and mixed back into channels,
+            # which is one projection of the channels: mixing matrix times unmixing matrix of the good components.
+            # mean added because data was whitened prior to ICA
+            self.proj = np.dot(self.A[:, goodcomp], self.W[goodcomp, :])
+
+            # with inplace, the projection is only applied to epochs._data in transform_epochs_object
+            if self.options['inplace'] == 'off':
+
+                # the data the decomposition was computed from, i.e. with the components 
+                # removed by an earlier transform_epochs_object added back
+                self.post = np.empty([len(self.S.ch_idx), self.S.shape[1], nevents], dtype=dtype)
+
+                for sl in misc.chunks(nevents, self.options['chunksize']):
+                    self.post[:, :, sl] = np.moveaxis(misc.project(  self.S.data_chunk(sl), 
+                                                                    self.proj, self.mean, dtype), 0, 2)
+
+            elif hasattr(self, 'post'):
+                del self.post
+
+        self._good = good
 
         # check if satisfied with result
         if self.options['confirm'] == 'on':
@@ -416,7 +672,7 @@ class TMSepochs:
 
             if newsettings:
                 self.set_options({'manualinput':'on'})
-                self.fastica()
+                self.fastica(warm_start=True)
 
             else:
                 self.set_options({'compcheck':'on'})
@@ -431,17 +687,41 @@ class TMSepochs:
     def transform_epochs_object(self):
 
         if self.options['remove'] == 'on':
-            try:
-                self.post
-            except:
+            if not hasattr(self, 'proj') or self.options['inplace'] == 'off' and not hasattr(self, 'post'):
                 self.inverse_transform()
 
-            ch_idx = [  i for i, chan in enumerate(self.epochs.ch_names) 
-                        if chan in self.options['chanpicks']]
+            ch_idx = self.S.ch_idx
+            dtype = self.options['dtype']
+
+            # only the time courses of the rejected components are kept, 
+            # so that they can still be restored by inverse_transform
+            removed = np.empty([len(self.badcomp), self.S.shape[1], self.S.shape[2]], dtype=dtype)
+
+            # write one block of epochs at a time into epochs._data (which may be memory-mapped),
+            # without a chunksize in blocks of about misc.block_bytes
+            chunksize = misc.block_size(len(ch_idx)*self.S.shape[1]*np.dtype(dtype).itemsize, 
+                                        self.options['chunksize'])
+
+            for sl in misc.chunks(len(self.epochs._data), chunksize):
+
+                X = self.S.data_chunk(sl)
+                removed[:, :, sl] = self.S.unmix(X, self.badcomp)
+
+                if self.options['inplace'] == 'on':
+                    self.epochs._data[sl, ch_idx, :] = misc.project(X, self.proj, self.mean, dtype)
+                else:
+                    self.epochs._data[sl, ch_idx, :] = np.moveaxis(self.post[:, :, sl], 2, 0)
+
+            if isinstance(self.epochs._data, np.memmap):
+                self.epochs._data.flush()
+
+            # the component time courses stay those of the decomposed data
+            self.S.removed = (self.A[:, self.badcomp], removed)
 
-            self.epochs._data[:, ch_idx, :] = np.moveaxis(self.post, 2, 0)
             self.transformed = True
-            self.rank = np.linalg.matrix_rank(self.epochs._data)
+
+            # each rejected component removes one dimension of the decomposed data
+            self.rank = self.rank - len(self.badcomp)
 
 
             print('\n{} independent components removed from data.\n'.format(len(self.badcomp)))
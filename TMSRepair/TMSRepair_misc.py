@@ -1,6 +1,8 @@
 import mne
 import numpy as np
 
+from functools import lru_cache
+
 
 
 def check_param(inst):
@@ -19,6 +21,48 @@ def check_param(inst):
     else:
         options['comps'] = len(options['chanpicks'])
 
+    # check the number of epochs processed at once
+    if options['chunksize'] is not None:
+        if not isinstance(options['chunksize'], (int, np.integer)) or options['chunksize'] < 1:
+            raise ValueError('Input for \'chunksize\' must be None or a positive integer.')
+
+    # check the decomposition cache
+    if options['cachedir'] is not None and not isinstance(options['cachedir'], str):
+        raise ValueError('Input for \'cachedir\' must be None or a path.')
+    elif options['cachesize'] <= 0:
+        raise ValueError('Input for \'cachesize\' must be larger than 0 (MB).')
+
+    if options['seed'] is not None and not isinstance(options['seed'], (int, np.integer)):
+        raise ValueError('Input for \'seed\' must be None or an integer.')
+
+    if options['classifier'] is not None and not isinstance(options['classifier'], str):
+        raise ValueError('Input for \'classifier\' must be None or the path of a saved classifier.')
+
+    # check the PCA compression before the ICA
+    if options['pcacomps'] is not None:
+        if not isinstance(options['pcacomps'], (int, np.integer)) or options['pcacomps'] < 1:
+            raise ValueError('Input for \'pcacomps\' must be None or a positive integer.')
+
+    if options['pcavar'] is not None and not 0 < options['pcavar'] <= 1:
+        raise ValueError('Input for \'pcavar\' must be None or a fraction of variance larger than 0 and at most 1.')
+
+    # check the subsampling of the data the ICA is fitted on
+    if not isinstance(options['fit_decim'], (int, np.integer)) or options['fit_decim'] < 1:
+        raise ValueError('Input for \'fit_decim\' must be a positive integer.')
+
+    if not 0 < options['fit_fraction'] <= 1:
+        raise ValueError('Input for \'fit_fraction\' must be larger than 0 and at most 1.')
+
+    # check the precision of the ICA and the reconstruction
+    if options['dtype'] not in ['float64', 'float32']:
+        raise ValueError('Input for \'dtype\' must be either \'float64\' or \'float32\'.')
+
+    if options['prerender'] not in ['on', 'off']:
+        raise ValueError('Input for \'prerender\' must be either \'on\' or \'off\'.')
+
+    if options['inplace'] not in ['on', 'off']:
+        raise ValueError('Input for \'inplace\' must be either \'on\' or \'off\'.')
+
     # check figure inputs
     accepted_strings = ['small', 'medium', 'large']
     if options['figsize'].lower() not in accepted_strings:
@@ -105,6 +149,11 @@ def check_param(inst):
 
 def eval_param(options, kwargs):
 
+    from copy import deepcopy
+
+    # never change the options passed in, they may be shared
+    options = deepcopy(options)
+
     for opt, val in kwargs.items():
 
         opt = opt.lower()
@@ -120,6 +169,29 @@ def eval_param(options, kwargs):
 
 
 
+def freeze_param(options):
+
+    """
+    Hashable, immutable snapshot of the options, 
+    e.g. to compare settings or to use them as a cache key.
+    Lists become tuples and the dictionary a sorted tuple of (name, value) pairs.
+    """
+
+    def freeze(val):
+        if isinstance(val, dict):
+            return freeze_param(val)
+        elif isinstance(val, (list, tuple, np.ndarray)):
+            return tuple(freeze(v) for v in val)
+        elif isinstance(val, np.generic):
+            return val.item()
+        return val
+
+    return tuple(sorted((opt, freeze(val)) for opt, val in options.items()))
+
+
+
+
+
 def chan_visual_inspection(x, indexmode = 'exclude'):
 
     """
@@ -242,28 +314,1260 @@ def MNE_raw_format(eegdata, ch_names, sfreq):
 
 
 
-def cubic_interpolation(epochs, win):
+def minmax_envelope(x, y, npix):
 
-    from scipy import interpolate
+    """
+    Display decimation of lines: the samples are split into npix bins (about one per pixel column) 
+    and only the minimum and maximum of each bin are kept, so that peaks stay visible
+    while the number of drawn vertices is bounded by the screen resolution.
+
+    Args:
+        x (numpy array): x values (timepoints)
+        y (numpy array): y values, timepoints in the last axis (e.g. channels*timepoints)
+        npix (int): number of bins
+
+    Returns:
+        x, y : numpy arrays with 2*npix timepoints (unchanged if there are fewer samples)
+    """
 
-    x = epochs.times
+    n = np.shape(y)[-1]
+    if n <= 2*npix:
+        return x, y
 
-    # convert window to indices in epochs; +1 because it should include the last timepoint
-    idx1 = np.argmin(np.abs(x - win[0]*0.001))
-    idx2 = np.argmin(np.abs(x - win[1]*0.001)) +1
+    edges = np.linspace(0, n, npix + 1).astype(int)[:-1]
 
-    # delete timepoints that should be interpolated
-    x = np.delete(x, np.s_[idx1:idx2], 0)
+    # min and max of each bin, both at the center of the bin
+    xc = np.repeat((x[edges] + x[np.append(edges[1:], n) - 1]) / 2, 2)
+    yc = np.stack([np.minimum.reduceat(y, edges, axis=-1), np.maximum.reduceat(y, edges, axis=-1)], -1)
 
-    for i, epoch in enumerate(epochs):
+    return xc, np.reshape(yc, np.shape(y)[:-1] + (2*npix,))
 
-        y = np.delete(epoch, np.s_[idx1:idx2], -1)
-        p = interpolate.interp1d(x, y, kind='cubic')
 
-        # get the interpolation values for the timepoints of interest
-        interp_values = p.__call__(epochs.times[idx1:idx2])
 
-        # for each epoch replace timepoints in epochs object
-        epochs._data[i, :, idx1:idx2] = interp_values
+
+def decimate_image(M, shape):
+
+    """
+    Display decimation of an image (e.g. trials*timepoints) to at most shape (rows, columns) pixels,
+    keeping the value with the largest magnitude in each block, so that peaks stay visible.
+    """
+
+    for axis, npix in enumerate(shape):
+
+        n = np.shape(M)[axis]
+        if n <= npix:
+            continue
+
+        edges = np.linspace(0, n, npix + 1).astype(int)[:-1]
+        low = np.minimum.reduceat(M, edges, axis=axis)
+        high = np.maximum.reduceat(M, edges, axis=axis)
+        M = np.where(np.abs(low) > np.abs(high), low, high)
+
+    return M
+
+
+
+
+def win_to_idx(times, win):
+
+    """
+    Converts a window in ms to sample indices of the epochs.
+
+    Args:
+        times (numpy array): epochs times in s
+        win (list): [start, end] in ms
+
+    Returns:
+        idx1, idx2 : start and stop index, stop is +1 to include the last timepoint
+    """
+
+    idx1 = np.argmin(np.abs(times - win[0]*0.001))
+    idx2 = np.argmin(np.abs(times - win[1]*0.001)) +1
+
+    return idx1, idx2
+
+
+
+
+def win_to_mask(times, win, pulses=None):
+
+    """
+    Converts one or several windows in ms to one boolean mask over the epochs timepoints.
+
+    Args:
+        times (numpy array): epochs times in s
+        win (list): [start, end] or list of windows [[start, end], ...] in ms
+        pulses (list): optional pulse times in ms relative to the epoch, 
+            in which case the window(s) are taken relative to each pulse
+
+    Returns:
+        mask : boolean numpy array, True for the timepoints in any of the windows
+    """
+
+    wins = np.atleast_2d(np.asarray(win, dtype=float))
+
+    if wins.shape[1] != 2:
+        raise ValueError('Windows must be in the following format: [start, end] or [[start, end], ...].')
+
+    if pulses is not None:
+        wins = (np.asarray(pulses, dtype=float)[:, None, None] + wins[None, :, :]).reshape(-1, 2)
+
+    mask = np.zeros(len(times), dtype=bool)
+
+    for w in wins:
+        idx1, idx2 = win_to_idx(times, w)
+        mask[idx1:idx2] = True
+
+    return mask
+
+
+
+
+def mask_to_segments(mask):
+
+    """
+    Start and stop indices of the contiguous segments in a boolean mask.
+    """
+
+    edges = np.flatnonzero(np.diff(np.r_[0, mask.astype(np.int8), 0]))
+
+    return list(zip(edges[::2], edges[1::2]))
+
+
+
+
+def chunks(n, chunksize=None):
+
+    """
+    Slices over n epochs in blocks of chunksize epochs.
+    If chunksize is None, one slice over all epochs is returned.
+    """
+
+    if chunksize is None:
+        chunksize = max(n, 1)
+
+    return [slice(start, min(start+chunksize, n)) for start in range(0, n, chunksize)]
+
+
+
+
+def memmap_epochs(epochs, fname, chunksize=None):
+
+    """
+    Streams the data of an epochs object into a memory-mapped .npy file on disk
+    and attaches it as epochs._data. The data is read in blocks of chunksize epochs, 
+    so neither preloaded nor on-disk (not preloaded) epochs need to fit into memory.
+
+    Args:
+        epochs (mne epochs object): preloaded or not preloaded epochs
+        fname (str): path of the .npy file the data is written to
+        chunksize (int): number of epochs read and written at once
+
+    Returns:
+        epochs : mne epochs object with epochs._data memory-mapped from fname
+    """
+
+    if not epochs.preload:
+        epochs.drop_bad(verbose=0)
+
+    n_epochs = len(epochs)
+    n_chans = len(epochs.ch_names)
+    n_times = len(epochs.times)
+
+    data = np.lib.format.open_memmap(fname, mode='w+', dtype=np.float64, 
+                                     shape=(n_epochs, n_chans, n_times))
+
+    for sl in chunks(n_epochs, chunksize):
+        data[sl] = epochs.get_data(item=np.arange(sl.start, sl.stop), verbose=0)
+
+    data.flush()
+
+    epochs._data = data
+    epochs.preload = True
 
     return epochs
+
+
+
+
+def concat_epochs(data, ch_idx, dtype=np.float64, chunksize=None, tidx=None, cols=None):
+
+    """
+    Picked channels of all epochs concatenated to channels*(timepoints*epochs),
+    with the epochs as the fastest changing index. Filled block-wise, 
+    directly in the requested precision.
+
+    Args:
+        data (numpy array): epochs*channels*timepoints
+        ch_idx (list): indices of the picked channels
+        dtype (str or numpy dtype): precision of the output
+        chunksize (int): number of epochs copied at once
+        tidx (numpy array): indices of the timepoints used, defaults to all
+        cols (numpy array): sorted indices of the concatenated columns returned, defaults to all.
+            Only these columns are gathered, the full concatenation is never built
+
+    Returns:
+        data_concat : numpy array
+    """
+
+    nevents, _, npnts = np.shape(data)
+    if tidx is None:
+        tidx = np.arange(npnts)
+
+    if cols is None:
+        data_concat = np.empty([len(ch_idx), len(tidx), nevents], dtype=dtype)
+
+        for sl in chunks(nevents, chunksize):
+            data_concat[:, :, sl] = np.moveaxis(data[sl][:, ch_idx, :][:, :, tidx], 0, 2)
+
+        return np.reshape(data_concat, [len(ch_idx), -1])
+
+    # epoch and timepoint of each column
+    events, times = cols % nevents, tidx[cols // nevents]
+    data_concat = np.empty([len(ch_idx), len(cols)], dtype=dtype)
+
+    for sl in chunks(nevents, chunksize):
+        m = (events >= sl.start) & (events < sl.stop)
+        data_concat[:, m] = data[sl][events[m] - sl.start, :, times[m]][:, ch_idx].T
+
+    return data_concat
+
+
+
+
+def sample_columns(n, fraction, seed=None):
+
+    """
+    Sorted random subset of round(fraction*n) of n column indices.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    return np.sort(rng.choice(n, max(1, int(round(fraction*n))), replace=False))
+
+
+
+
+def data_mean(data, ch_idx, chunksize=None):
+
+    """
+    Mean over epochs (channels*timepoints) of the picked channels, accumulated over blocks of epochs.
+    """
+
+    erp = np.zeros([len(ch_idx), np.shape(data)[2]])
+
+    for sl in chunks(len(data), chunksize):
+        erp += np.sum(data[sl][:, ch_idx, :], axis=0)
+
+    return erp/len(data)
+
+
+
+
+def project(X, proj, mean, dtype=np.float64):
+
+    """
+    Applies a linear projection of the channels to a block of epochs around the channel mean:
+    proj @ (X - mean) + mean
+
+    X is not copied if it already has precision dtype and is then overwritten,
+    blocks of picked channels are copies already (fancy indexing).
+
+    Args:
+        X (numpy array): epochs*channels*timepoints
+        proj (numpy array): channels*channels projection matrix
+        mean (numpy array): channel mean
+        dtype (str or numpy dtype): precision of the computation
+
+    Returns:
+        numpy array: projected epochs*channels*timepoints, in precision dtype
+    """
+
+    X = np.asarray(X, dtype=dtype)
+    X -= mean[None, :, None].astype(dtype)
+    X = np.matmul(proj.astype(dtype), X)
+    X += mean[None, :, None].astype(dtype)
+
+    return X
+
+
+
+
+def data_cov(data, ch_idx, chunksize=None, tidx=None):
+
+    """
+    Channel means and covariance of the picked channels over all epochs and timepoints,
+    accumulated over blocks of epochs, so that no concatenated copy of the data is needed.
+
+    Args:
+        data (numpy array): epochs*channels*timepoints
+        ch_idx (list): indices of the picked channels
+        chunksize (int): number of epochs processed at once
+        tidx (numpy array): indices of the timepoints used, defaults to all
+
+    Returns:
+        mean : numpy array, mean of each picked channel
+        cov : numpy array, channels*channels covariance matrix
+        n : int, number of samples per channel
+    """
+
+    if tidx is None:
+        tidx = np.arange(np.shape(data)[2])
+
+    # accumulate around the mean of the first block to avoid cancellation for large offsets
+    shift = np.mean(data[:1][:, ch_idx, :][:, :, tidx], axis=(0, 2))
+    total = np.zeros(len(ch_idx))
+    cross = np.zeros([len(ch_idx), len(ch_idx)])
+    n = 0
+
+    for sl in chunks(len(data), chunksize):
+        X = data[sl][:, ch_idx, :][:, :, tidx] - shift[:, None]
+        total += np.sum(X, axis=(0, 2))
+        cross += np.tensordot(X, X, axes=([0, 2], [0, 2]))
+        n += X.shape[0]*X.shape[2]
+
+    mean = total/n
+    cov = cross/n - np.outer(mean, mean)
+
+    return mean + shift, cov, n
+
+
+
+
+def pca(cov, n):
+
+    """
+    Eigendecomposition of a covariance matrix, replacing an SVD of the full data.
+
+    Args:
+        cov (numpy array): channels*channels covariance matrix
+        n (int): number of samples the covariance was computed from
+
+    Returns:
+        rank : int, number of eigenvalues above the tolerance 
+            largest eigenvalue * max(channels, n) * eps. This is the tolerance 
+            np.linalg.matrix_rank applies to singular values, here applied to the 
+            eigenvalues (squared singular values) without squaring it, since eigenvalues 
+            computed from the covariance are only accurate to about eps * largest eigenvalue
+        eigval : numpy array, eigenvalues in descending order
+        eigvec : numpy array, eigenvectors in columns, same order
+    """
+
+    eigval, eigvec = np.linalg.eigh(cov)
+    eigval, eigvec = eigval[::-1], eigvec[:, ::-1]
+
+    tol = eigval[0] * max(len(eigval), n) * np.finfo(eigval.dtype).eps
+    rank = int(np.sum(eigval > tol))
+
+    return rank, eigval, eigvec
+
+
+
+
+def pca_ncomps(eigval, rank, pcacomps=None, pcavar=None):
+
+    """
+    Number of principal components kept before the ICA: at most the rank, 
+    at most pcacomps, and the fewest components explaining at least 
+    the fraction pcavar of the variance.
+    """
+
+    ncomps = rank
+
+    if pcacomps is not None:
+        ncomps = min(ncomps, pcacomps)
+
+    if pcavar is not None:
+        explained = np.cumsum(eigval[:rank]) / np.sum(eigval[:rank])
+        ncomps = min(ncomps, int(np.searchsorted(explained, pcavar*(1 - 1e-12))) + 1)
+
+    return ncomps
+
+
+
+
+def whitening(eigval, eigvec, ncomps):
+
+    """
+    PCA whitening matrix (ncomps*channels) for the first ncomps principal components, 
+    and its pseudo-inverse (channels*ncomps) to project back to channel space.
+    """
+
+    K = (eigvec[:, :ncomps] / np.sqrt(eigval[:ncomps])).T
+    Kinv = eigvec[:, :ncomps] * np.sqrt(eigval[:ncomps])
+
+    return K, Kinv
+
+
+
+
+# size of the blocks of time courses or data computed at once if no chunksize is set
+block_bytes = 64*2**20
+
+
+
+
+def block_size(nbytes, chunksize=None):
+
+    """
+    Number of epochs processed at once: chunksize, 
+    or if it is None as many epochs of nbytes each as fit into block_bytes.
+    """
+
+    if chunksize is not None:
+        return chunksize
+
+    return max(1, block_bytes // max(1, nbytes))
+
+
+
+
+class Sources:
+
+    """
+    Lazy view of the ICA component time courses (components*timepoints*epochs).
+    Only the unmixing matrix and a reference to the epochs data are stored,
+    the time courses are computed on demand, per component or per block of epochs.
+    The components that were used last and the mean over epochs are cached, 
+    so clear() has to be called after the referenced data was changed.
+    Components removed from the data can be kept in removed (topographies, 
+    time courses), they are added back to the data before unmixing.
+
+    Args:
+        data (numpy array): epochs*channels*timepoints
+        ch_idx (list): indices of the picked channels
+        W (numpy array): unmixing matrix, components*picked channels
+        mean (numpy array): channel mean subtracted before unmixing
+        dtype (str or numpy dtype): precision of the time courses
+        chunksize (int): number of epochs processed at once, 
+            if None blocks of about block_bytes of time courses
+        cachesize (int): number of component time courses kept in memory
+    """
+
+    def __init__(self, data, ch_idx, W, mean, dtype='float64', chunksize=None, cachesize=8):
+
+        from collections import OrderedDict
+
+        self.data = data
+        self.ch_idx = ch_idx
+        self.W = W
+        self.chanmean = mean
+        self.dtype = np.dtype(dtype)
+        self.chunksize = chunksize
+        self.cachesize = cachesize
+
+        nevents, _, npnts = np.shape(data)
+        self.shape = (len(W), npnts, nevents)
+        self.ndim = 3
+
+        self.removed = None
+
+        self._cache = OrderedDict()
+        self._erp = None
+
+
+    def clear(self):
+
+        """
+        Drops the cached time courses and mean, e.g. after the data changed.
+        """
+
+        self._cache.clear()
+        self._erp = None
+
+
+    def data_chunk(self, sl):
+
+        """
+        Picked channels of the epochs in slice sl (epochs*channels*timepoints), 
+        with the removed components added back.
+        """
+
+        X = np.asarray(self.data[sl][:, self.ch_idx, :], dtype=self.dtype)
+
+        if self.removed is not None:
+            A, R = self.removed
+            X += np.moveaxis(np.tensordot(A.astype(self.dtype), R[:, :, sl], axes=1), 2, 0)
+
+        return X
+
+
+    def data_mean(self):
+
+        """
+        Mean over epochs (channels*timepoints) of the picked channels, with the removed components added back.
+        """
+
+        erp = data_mean(self.data, self.ch_idx, self.chunksize)
+
+        if self.removed is not None:
+            A, R = self.removed
+            erp += np.dot(A, np.mean(R, axis=2))
+
+        return erp
+
+
+    def unmix(self, X, comps=None):
+
+        """
+        Time courses (components*timepoints*epochs) of a block of picked data (epochs*channels*timepoints),
+        for all components or the components in comps.
+        """
+
+        W = self.W if comps is None else self.W[comps]
+
+        X = X - self.chanmean[None, :, None].astype(self.dtype)
+
+        return np.moveaxis(np.tensordot(W.astype(self.dtype), X, axes=([1], [1])), 1, 2)
+
+
+    def __len__(self):
+
+        return self.shape[0]
+
+
+    def chunk(self, sl, comps=None):
+
+        """
+        Time courses (components*timepoints*epochs) of the epochs in slice sl,
+        for all components or the components in comps.
+        """
+
+        return self.unmix(self.data_chunk(sl), comps)
+
+
+    def chunks(self, comps=None):
+
+        """
+        Iterates over (slice, time courses) for blocks of chunksize epochs.
+        Without a chunksize, the blocks hold about block_bytes of time courses.
+        """
+
+        ncomps = self.shape[0] if comps is None else len(comps)
+        chunksize = block_size(ncomps*self.shape[1]*self.dtype.itemsize, self.chunksize)
+
+        for sl in chunks(self.shape[2], chunksize):
+            yield sl, self.chunk(sl, comps)
+
+
+    def component(self, compnum):
+
+        """
+        Time course matrix (timepoints*epochs) of one component. On a cache miss
+        the following components are computed in the same pass over the data,
+        since components are mostly inspected in order.
+        """
+
+        if compnum in self._cache:
+            self._cache.move_to_end(compnum)
+            return self._cache[compnum]
+
+        comps = list(range(compnum, min(compnum + self.cachesize, self.shape[0])))
+        block = np.empty([len(comps), self.shape[1], self.shape[2]], dtype=self.dtype)
+
+        for sl, S in self.chunks(comps):
+            block[:, :, sl] = S
+
+        for i, comp in enumerate(comps):
+            self._cache[comp] = block[i]
+            self._cache.move_to_end(comp)
+
+        while len(self._cache) > self.cachesize:
+            self._cache.popitem(last=False)
+
+        return self._cache[compnum]
+
+
+    def mean(self, axis=None, dtype=None, out=None, **kwargs):
+
+        """
+        Mean as np.mean. The mean over epochs (axis 2) is computed from
+        the mean over epochs of the data, without the single trial time courses.
+        """
+
+        if axis == 2 and out is None:
+
+            if self._erp is None:
+                erp = self.data_mean() - self.chanmean[:, None]
+                self._erp = np.dot(self.W, erp).astype(self.dtype)
+
+            return self._erp
+
+        return np.mean(np.asarray(self), axis=axis, dtype=dtype, out=out, **kwargs)
+
+
+    def __getitem__(self, key):
+
+        if isinstance(key, (int, np.integer)):
+            return self.component(key)
+        elif isinstance(key, tuple) and isinstance(key[0], (int, np.integer)):
+            return self.component(key[0])[key[1:]]
+
+        return np.asarray(self)[key]
+
+
+    def __array__(self, dtype=None, copy=None):
+
+        S = np.empty(self.shape, dtype=self.dtype)
+
+        for sl, chunk in self.chunks():
+            S[:, :, sl] = chunk
+
+        return S if dtype is None else S.astype(dtype)
+
+
+
+
+@lru_cache(maxsize=16)
+def fft_bins(sfreq, L, plotfreqx):
+
+    """
+    Maps the spectrum of L samples, zero-padded to the next power of 2, 
+    to frequency bins of 0.5 Hz in width centered around the frequencies 
+    plotfreqx[0], plotfreqx[0]+0.5, ..., plotfreqx[1]. 
+    Computed once per (sfreq, L, plotfreqx) and cached.
+
+    Args:
+        sfreq (float): sampling frequency
+        L (int): number of samples
+        plotfreqx (tuple): (low, high) frequency range
+
+    Returns:
+        NFFT : int, length of the FFT
+        freq : numpy array, bin center frequencies
+        edges : numpy array, FFT indices of the bin borders, bin i is edges[i]:edges[i+1]
+        counts : numpy array, number of FFT frequencies in each bin
+    """
+
+    # find the next power of 2 from the length of Y
+    NFFT = int(2**np.ceil(np.log2(abs(L))))
+    f = sfreq/2 * np.linspace(0, 1, int(NFFT/2+1))
+    freq = np.arange(plotfreqx[0], plotfreqx[1]+ 0.5, 0.5)
+
+    # the upper border of each bin is the lower border of the next one
+    borders = np.r_[freq - 0.25, freq[-1] + 0.25]
+    edges = np.argmin(np.abs(np.subtract.outer(borders, f)), axis=1)
+
+    for arr in [freq, edges]:
+        arr.flags.writeable = False
+
+    return NFFT, freq, edges, np.diff(edges)
+
+
+
+
+def bin_spectrum(power, edges, counts):
+
+    """
+    Mean of power (axis 1 = frequency) within each bin, in one np.add.reduceat.
+    Empty bins are nan.
+    """
+
+    power = power[:, :edges[-1]]
+    starts = np.minimum(edges[:-1], max(power.shape[1]-1, 0))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        binned = np.add.reduceat(power, starts, axis=1) / counts[None, :, None]
+
+    binned[:, counts == 0] = np.nan
+
+    return binned
+
+
+
+
+def component_spectra(S, sfreq, plotfreqx, comps):
+
+    """
+    Power spectrum of the z-scored component time courses, binned and averaged over epochs.
+    Computed for one block of epochs at a time, so neither the z-scored time courses
+    nor the single trial spectra exist for all epochs at once.
+
+    Args:
+        S (Sources): component time courses
+        sfreq (float): sampling frequency
+        plotfreqx (list): [low, high] frequency range
+        comps (list): components of interest
+
+    Returns:
+        fftbins : numpy array, components*frequency bins
+    """
+
+    from scipy import fft
+    from scipy.stats import zscore
+
+    _, L, nevents = np.shape(S)
+    NFFT, freq, edges, counts = fft_bins(float(sfreq), int(L), tuple(plotfreqx))
+
+    fftbins = np.zeros([len(comps), len(freq)])
+
+    for _, chunk in S.chunks(comps):
+
+        # scipy's fft keeps single precision input in single precision
+        Y = fft.rfft(zscore(chunk, axis=1), n=NFFT, axis=1)/L
+        fftbins += np.sum(bin_spectrum(np.abs(Y)**2, edges, counts), axis=2)
+
+    return (fftbins/nevents).astype(S.dtype)
+
+
+
+
+# artifact features of each component, in the order the classification rules are applied
+feature_names = ['tmsmuscle', 'blink', 'move1', 'move2', 'muscle', 'elecnoise', 'perc_var']
+
+# options the features depend on
+feature_opts = ['comps', 'chanpicks', 'plotfreqx', 'tmsmusclewin', 
+                'blinkelecs', 'moveelecs', 'musclefreqin', 'musclefreqex']
+
+# on/off switches of the rules, a feature is only computed if its rule is on
+feature_rules = ['tmsmuscle', 'blink', 'move', 'muscle', 'elecnoise']
+
+
+
+
+def comp_features(inst):
+
+    """
+    Table of the artifact features of each component, 
+    independent of the thresholds they are compared to.
+    Only the features of the rules that are switched on are computed, the others and 
+    features that can not be computed (e.g. electrodes missing) are nan.
+
+    Args:
+        inst (TMSepochs): instance after fastica()
+
+    Returns:
+        features : numpy structured array of length comps, with the fields in feature_names
+    """
+
+    from scipy.stats import zscore
+
+    options = inst.options
+    comps = options['comps']
+
+    features = np.full(comps, np.nan, dtype=[(name, np.float64) for name in feature_names])
+    features['perc_var'] = inst.perc_var[:comps]
+
+    # create zscore for each component across channels
+    tempCompZ = zscore(inst.A, 0)[:, :comps]
+
+    # tms muscle window
+    if options['tmsmuscle'] == 'on':
+        mt1 = np.argmin(np.abs(inst.epochs.times*1000 - options['tmsmusclewin'][0]))
+        mt2 = np.argmin(np.abs(inst.epochs.times*1000 - options['tmsmusclewin'][1]))
+
+        muscleScore = np.abs(np.mean(inst.S, 2))
+        winScore = np.mean(muscleScore[:, mt1:mt2], 1)
+        features['tmsmuscle'] = (winScore / np.mean(muscleScore))[:comps]
+
+    # eyeblinks
+    blinkidx = [i for i, chan in enumerate(options['chanpicks']) if chan in options['blinkelecs']]
+    if options['blink'] == 'on' and len(blinkidx) > 0:
+        features['blink'] = np.mean(tempCompZ[blinkidx, :], 0)
+
+    # lateral eye movements
+    moveidx = [i for i, chan in enumerate(options['chanpicks']) if chan in options['moveelecs']]
+    if options['move'] == 'on' and len(moveidx) >= 2:
+        features['move1'] = tempCompZ[moveidx[0], :]
+        features['move2'] = tempCompZ[moveidx[1], :]
+
+    # electrode noise
+    if options['elecnoise'] == 'on':
+        features['elecnoise'] = np.amax(np.abs(tempCompZ), axis=0)
+
+    if options['muscle'] == 'on':
+        features['muscle'] = muscle_slope(inst.compute_spectra(), options)
+
+    return features
+
+
+
+
+def muscle_slope(fftbins, options):
+
+    """
+    Slope of a line fitted to the log-log power spectrum of each component,
+    used to detect persistent muscle activity. Bins at 0 Hz or below are left out.
+
+    Args:
+        fftbins (numpy array): components*frequency bins, as from component_spectra
+        options (dict): plotfreqx, musclefreqin and musclefreqex
+
+    Returns:
+        numpy array: slope of each component
+    """
+
+    # get indices for frequency range to detect persistent muscle activity
+    freq = np.arange(options['plotfreqx'][0], options['plotfreqx'][1]+ 0.5, 0.5)
+
+    # frequencies to include into fit
+    if len(options['musclefreqin']) != 0:
+        fin1 = np.argmin(np.abs(freq-options['musclefreqin'][0]))
+        fin2 = np.argmin(np.abs(freq-options['musclefreqin'][1]))
+        freqHz = freq[fin1:fin2]
+    else:
+        freqHz = freq
+
+    # frequencies to exclude from fit
+    if len(options['musclefreqex']) != 0:
+        fex1 = np.argmin(np.abs(freqHz-options['musclefreqex'][0]))
+        fex2 = np.argmin(np.abs(freqHz-options['musclefreqex'][1]))
+        np.delete(freqHz, slice(fex1, fex2))
+
+    # the logarithm is only defined for positive frequencies
+    freqHz = freqHz[freqHz > 0]
+
+    # get idx of frequencies in power spectrum
+    musclefidx = [i for i, f in enumerate(freq) if f in freqHz]
+
+    # polynomial fit for each component, store the slope
+    freqPow = fftbins[:, musclefidx]
+    p = np.polyfit(np.log(freqHz), np.log(freqPow).T, 1)
+
+    return p[0,:]
+
+
+
+
+def classify(features, options):
+
+    """
+    Component classes from the feature table, evaluated for all components at once.
+    The rules are applied in the order tms muscle (2), eyeblink (3), lateral eye movement (4),
+    persistent muscle activity (5), electrode noise (6), otherwise neural (1).
+    Thresholds may also be arrays broadcasting against the features, e.g. of shape 
+    (n settings, 1), to classify for many settings at once.
+
+    Args:
+        features (numpy structured array): output of comp_features
+        options (dict): on/off switches and thresholds of the rules
+
+    Returns:
+        compclass : numpy array of classes, components in the last axis
+    """
+
+    conds = []
+    classes = []
+
+    if options['tmsmuscle'] == 'on':
+        conds.append(features['tmsmuscle'] >= np.asarray(options['tmsmusclethresh'])) 
+        classes.append(2)
+
+    if options['blink'] == 'on':
+        conds.append(np.abs(features['blink']) >= np.asarray(options['blinkthresh']))
+        classes.append(3)
+
+    if options['move'] == 'on':
+        movethresh = np.asarray(options['movethresh'])
+        conds.append(   (features['move1'] >= movethresh) & (features['move2'] <= -movethresh)
+                        | (features['move2'] >= movethresh) & (features['move1'] <= -movethresh))
+        classes.append(4)
+
+    if options['muscle'] == 'on':
+        conds.append(features['muscle'] >= np.asarray(options['musclethresh']))
+        classes.append(5)
+
+    if options['elecnoise'] == 'on':
+        conds.append(features['elecnoise'] >= np.abs(options['elecnoisethresh']))
+        classes.append(6)
+
+    # all conditions broadcast to the same shape, so that np.select picks the first rule that applies
+    conds = np.broadcast_arrays(*conds, np.zeros(np.shape(features), dtype=bool))
+
+    return np.select(conds[:-1], classes, default=1).astype(np.float64)
+
+
+
+
+def comp_vectors(inst):
+
+    """
+    Input vectors of the component classifier: the artifact features, 
+    the z-scored topography (sign normalized, as the sign of a component is arbitrary),
+    and the log spectrum relative to its mean.
+
+    Args:
+        inst (TMSepochs): instance after compute_features()
+
+    Returns:
+        vectors : numpy array (comps, features + channels + frequency bins)
+    """
+
+    from scipy.stats import zscore
+
+    comps = inst.options['comps']
+
+    features = np.stack([inst.features[name] for name in feature_names], 1)
+
+    topo = zscore(inst.A, 0)[:, :comps].T
+    topo *= np.sign(topo[np.arange(comps), np.argmax(np.abs(topo), 1)])[:, None]
+
+    spectrum = np.log(inst.compute_spectra()[:comps])
+    spectrum -= np.nanmean(spectrum, 1, keepdims=True)
+
+    return np.concatenate([features, topo, spectrum], 1)
+
+
+
+
+def classifier_fit(vectors, labels):
+
+    """
+    Fits a multinomial logistic regression on component vectors (see comp_vectors)
+    and their reviewed classes. Missing values (e.g. features that could not be
+    computed) are replaced by zero after scaling.
+
+    Returns:
+        model : sklearn pipeline
+    """
+
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.impute import SimpleImputer
+    from sklearn.linear_model import LogisticRegression
+
+    model = make_pipeline(  StandardScaler(), 
+                            SimpleImputer(strategy='constant', fill_value=0), 
+                            LogisticRegression(max_iter=1000))
+
+    return model.fit(vectors, np.asarray(labels, dtype=int))
+
+
+
+
+def classifier_save(fname, model, chanpicks, plotfreqx):
+
+    """
+    Saves a fitted classifier together with the channels and frequency range 
+    its vectors were computed from.
+    """
+
+    import pickle
+
+    with open(fname, 'wb') as file:
+        pickle.dump({'model': model, 'chanpicks': list(chanpicks), 'plotfreqx': list(plotfreqx)}, file)
+
+
+
+
+def classifier_load(fname):
+
+    """
+    Loads a classifier saved with classifier_save, 
+    only reading the file again if it changed.
+    """
+
+    import os
+
+    return _classifier_load(os.path.abspath(fname), os.path.getmtime(fname))
+
+
+
+
+@lru_cache(maxsize=4)
+def _classifier_load(fname, mtime):
+
+    import pickle
+
+    with open(fname, 'rb') as file:
+        return pickle.load(file)
+
+
+
+
+def classifier_predict(clf, vectors, chanpicks, plotfreqx):
+
+    """
+    Component classes predicted by a loaded classifier for the stacked 
+    vectors of one or many subjects.
+
+    Args:
+        clf (dict): classifier as loaded with classifier_load
+        vectors (numpy array): component vectors (see comp_vectors), components in rows
+        chanpicks (list): channels the vectors were computed from
+        plotfreqx (list): frequency range of the spectra in the vectors
+
+    Returns:
+        compclass : numpy array of classes
+    """
+
+    if list(chanpicks) != clf['chanpicks'] or list(plotfreqx) != clf['plotfreqx']:
+        raise ValueError('The classifier was trained on channels {} and frequencies {}, '
+                         'it can not be applied to channels {} and frequencies {}.'.format(
+                            clf['chanpicks'], clf['plotfreqx'], list(chanpicks), list(plotfreqx)))
+
+    return clf['model'].predict(vectors).astype(np.float64)
+
+
+
+
+def decomp_key(W, A):
+
+    """
+    Hash of a decomposition, to check that component labels 
+    are applied to the decomposition they were made for.
+    """
+
+    import hashlib
+
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(W).tobytes())
+    h.update(np.ascontiguousarray(A).tobytes())
+
+    return h.hexdigest()
+
+
+
+
+def ica_key(data, ch_idx, options, tidx=None):
+
+    """
+    Hash of the picked data, the timepoints fitted on and the settings that 
+    determine the ICA decomposition, used as file name in the decomposition cache.
+    """
+
+    import hashlib
+
+    h = hashlib.sha1()
+    h.update(repr(np.shape(data)).encode())
+
+    for sl in chunks(len(data), options['chunksize']):
+        h.update(np.ascontiguousarray(data[sl][:, ch_idx, :]).tobytes())
+
+    if tidx is not None:
+        h.update(np.asarray(tidx, dtype=np.int64).tobytes())
+
+    # comps only limits the components shown and classified, not the decomposition
+    keyed = ['approach', 'g', 'seed', 'fit_decim', 'fit_fraction', 'pcacomps', 'pcavar', 'dtype']
+    h.update(repr(freeze_param({opt: str(np.dtype(options[opt])) if opt == 'dtype' else options[opt] 
+                                for opt in keyed})).encode())
+
+    return h.hexdigest()
+
+
+
+
+def cache_load(cachedir, key):
+
+    """
+    Loads the arrays stored under key in cachedir, or returns None if there are none.
+    A file that can not be read (e.g. evicted by another process meanwhile) is a cache miss.
+    """
+
+    import os
+    import zipfile
+
+    fname = os.path.join(cachedir, key + '.npz')
+
+    if not os.path.exists(fname):
+        return None
+
+    try:
+        # mark as recently used for the eviction
+        os.utime(fname)
+
+        with np.load(fname) as f:
+            return {name: f[name] for name in f.files}
+
+    except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+        return None
+
+
+
+
+def cache_save(cachedir, key, cachesize, **arrays):
+
+    """
+    Stores arrays under key in cachedir. If the cache grows beyond cachesize (MB),
+    the least recently used files are removed. The file is written under a temporary 
+    name and then renamed, so other processes never read a partly written file.
+    """
+
+    import os
+    import glob
+    import tempfile
+
+    os.makedirs(cachedir, exist_ok=True)
+    fname = os.path.join(cachedir, key + '.npz')
+
+    fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=cachedir)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(tmpname, fname)
+    except BaseException:
+        os.remove(tmpname)
+        raise
+
+    cache_evict(cachedir, '*.npz', cachesize, keep=fname)
+
+
+
+
+def cache_evict(cachedir, pattern, cachesize, keep=None):
+
+    """
+    Removes the least recently used entries (files or directories) matching pattern 
+    in cachedir, until their total size is at most cachesize (MB). keep is never removed.
+    Entries removed by other processes evicting at the same time are skipped.
+    """
+
+    import os
+    import glob
+    import shutil
+
+    def usage(entry):
+        try:
+            if os.path.isdir(entry):
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            else:
+                size = os.path.getsize(entry)
+            return os.path.getmtime(entry), size
+        except FileNotFoundError:
+            return None
+
+    entries = [(entry, use) for entry, use in ((entry, usage(entry)) 
+                for entry in glob.glob(os.path.join(cachedir, pattern))) if use is not None]
+    entries.sort(key=lambda item: item[1][0])
+    total = sum(size for _, (_, size) in entries)
+
+    for entry, (_, size) in entries:
+        if total <= cachesize*1e6:
+            break
+        if entry == keep:
+            continue
+
+        total -= size
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        else:
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                pass
+
+
+
+
+def interpolate_data(data, times, mask, support=None):
+
+    """
+    Cubic interpolation of the masked samples along the last axis of data,
+    for all epochs and channels in one array operation.
+    Without support, the same (not-a-knot) cubic spline scipy's interp1d fits
+    is used on all remaining samples, so results are identical to interpolating
+    each epoch separately. All windows in the mask are filled by one spline.
+    With support, a third order polynomial is fitted to the unmasked samples 
+    right before and after each window (as in TESA), so the cost does not 
+    depend on the epoch length.
+    Windows reaching the start or end of the epoch raise a ValueError.
+
+    Args:
+        data (numpy array): data with time as last axis, e.g. epochs*channels*timepoints
+        times (numpy array): timepoints of the last axis
+        mask (numpy array): boolean mask of the timepoints to be interpolated
+        support (list): number of samples [before, after] each window used for the fit
+
+    Returns:
+        data : numpy array, interpolated in place
+    """
+
+    if support is None:
+
+        from scipy import interpolate
+
+        # as with interp1d, windows reaching the start or end of the epoch can not be interpolated
+        if mask[0]:
+            raise ValueError('A value in x_new is below the interpolation range.')
+        if mask[-1]:
+            raise ValueError('A value in x_new is above the interpolation range.')
+
+        # fit on all timepoints that are not interpolated
+        p = interpolate.make_interp_spline(times[~mask], data[..., ~mask], k=3, axis=-1)
+
+        # get the interpolation values for the timepoints of interest
+        data[..., mask] = p(times[mask], extrapolate=False)
+
+    else:
+
+        # support samples of each window, all checked before any data is changed
+        fits = []
+
+        for idx1, idx2 in mask_to_segments(mask):
+
+            fit = np.r_[max(idx1-support[0], 0):idx1, idx2:min(idx2+support[1], len(times))]
+            fit = fit[~mask[fit]]
+
+            # the polynomial is only interpolated between both sides, never extrapolated
+            if not np.any(fit < idx1) or not np.any(fit >= idx2):
+                raise ValueError('Samples before and after each window are needed for cubic interpolation, '
+                                 'the window at {} - {} ms reaches the start or end of the epoch.'
+                                 .format(times[idx1]*1000, times[idx2-1]*1000))
+
+            if len(fit) < 4:
+                raise ValueError('At least 4 samples around the window are needed for cubic interpolation.')
+
+            fits.append((idx1, idx2, fit))
+
+        for idx1, idx2, fit in fits:
+
+            # least squares cubic fit and evaluation in the window are both linear,
+            # so they collapse into one (support samples x window samples) matrix.
+            # time in ms relative to the window start keeps the fit well conditioned
+            t0 = times[idx1]
+            V = np.vander((times[fit]-t0)*1000, 4)
+            Vwin = np.vander((times[idx1:idx2]-t0)*1000, 4)
+
+            data[..., idx1:idx2] = data[..., fit] @ (np.linalg.pinv(V).T @ Vwin.T)
+
+    return data
+
+
+
+
+def cubic_interpolation(epochs, win, support=None, pulses=None, chunksize=None):
+
+    mask = win_to_mask(epochs.times, win, pulses)
+
+    # convert support from ms to number of samples
+    if support is not None:
+        support = [int(round(ms*0.001*epochs.info['sfreq'])) for ms in support]
+
+    # replace timepoints for all channels and a block of epochs at once, 
+    # writing each block back into epochs._data (which may be memory-mapped)
+    for sl in chunks(len(epochs._data), chunksize):
+        interpolate_data(epochs._data[sl], epochs.times, mask, support)
+
+    if isinstance(epochs._data, np.memmap):
+        epochs._data.flush()
+
+    return epochs
+
+
+
+def erp_preview(epochs, win=(-5, 15), chunksize=None):
+
+    """
+    Evoked response for the bad channel preview: interpolated in the pulse window,
+    band-pass (0.5 - 49 Hz, IIR) and notch (50 Hz) filtered. As interpolation, filtering
+    and averaging are linear, the mean over epochs is computed first and only this
+    channels*timepoints array is processed. The epochs are not changed.
+
+    Args:
+        epochs (mne epochs object): epochs to preview
+        win (tuple): window [ms] interpolated around the pulse
+        chunksize (int): number of epochs averaged at once
+
+    Returns:
+        erp : numpy array (channels*timepoints)
+    """
+
+    sfreq = epochs.info['sfreq']
+
+    erp = data_mean(epochs._data, np.arange(len(epochs.ch_names)), chunksize)
+    erp = interpolate_data(erp, epochs.times, win_to_mask(epochs.times, win))
+
+    erp = mne.filter.filter_data(erp, sfreq, 0.5, 49, method='iir', verbose=0)
+    erp = mne.filter.notch_filter(erp, sfreq, 50, notch_widths=2, phase='zero', verbose=0)
+
+    return erp
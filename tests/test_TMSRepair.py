@@ -2,6 +2,7 @@ import unittest
 import pickle
 import numpy as np
 import sys
+import os
 sys.path.append('../TMSRepair')
 
 import TMSRepair
@@ -27,6 +28,19 @@ class TestTMSRepair(unittest.TestCase):
 
 
 
+    def test_options_per_instance(self):
+        chanpicks = list(self.inst1.options['chanpicks'])
+
+        inst2 = TMSRepair(self.inst1.epochs, options={'manualinput':'off', 'blinkthresh': 5})
+        inst2.options['chanpicks'] = inst2.options['chanpicks'][:3]
+
+        assert self.inst1.options['blinkthresh'] != 5
+        assert self.inst1.options['chanpicks'] == chanpicks
+
+        assert hash(self.inst1.config) != hash(inst2.config)
+
+
+
     def test_replace_with_zeros(self):
         orig_datashape = np.shape(self.inst1.epochs)
         self.inst1.replace_with_zeros([self.inst1.epochs.times[0]*1000, self.inst1.epochs.times[-1]*1000])
@@ -36,6 +50,20 @@ class TestTMSRepair(unittest.TestCase):
 
 
 
+    def test_replace_with_zeros_pulses(self):
+        x = self.inst1.epochs.times*1000
+        self.inst1.replace_with_zeros([-2, 5], pulses=[0, 100])
+
+        for pulse in [0, 100]:
+            idx1 = np.argmin(np.abs(x - (pulse-2)))
+            idx2 = np.argmin(np.abs(x - (pulse+5))) +1
+            assert np.sum(np.abs(self.inst1.epochs._data[:, :, idx1:idx2])) == 0
+
+        # data between the pulses is untouched
+        assert np.all(self.inst1.epochs._data[:, :, np.argmin(np.abs(x - 50))] != 0)
+
+
+
     def test_cubic_interpolation(self):
         from copy import copy
 
@@ -54,7 +82,181 @@ class TestTMSRepair(unittest.TestCase):
 
 
 
-    def test_fastica(self):
+    def test_cubic_interpolation_per_epoch(self):
+        from copy import copy
+        from scipy import interpolate
+
+        window = [-5, 15]
+
+        x = self.inst1.epochs.times
+        idx1 = np.argmin(np.abs(x - window[0]*0.001))
+        idx2 = np.argmin(np.abs(x - window[1]*0.001)) +1
+        x = np.delete(x, np.s_[idx1:idx2], 0)
+
+        # reference: one interp1d per epoch
+        expected = copy(self.inst1.epochs._data)
+        for i, epoch in enumerate(expected):
+            p = interpolate.interp1d(x, np.delete(epoch, np.s_[idx1:idx2], -1), kind='cubic')
+            expected[i, :, idx1:idx2] = p(self.inst1.epochs.times[idx1:idx2])
+
+        self.inst1.cubic_interpolation(window)
+
+        np.testing.assert_array_almost_equal(self.inst1.epochs._data, expected)
+
+
+
+    def test_cubic_interpolation_support(self):
+        window = [-5, 15]
+
+        # a cubic polynomial in time should be recovered exactly from its neighbourhood
+        x = self.inst1.epochs.times*1000
+        cubic = 1e-6 + 1e-8*x - 1e-10*x**2 + 1e-12*x**3
+        self.inst1.epochs._data[:] = cubic
+
+        idx1 = np.argmin(np.abs(x - window[0]))
+        idx2 = np.argmin(np.abs(x - window[1])) +1
+        self.inst1.epochs._data[:, :, idx1:idx2] = 0
+
+        self.inst1.cubic_interpolation(window, support=[5, 5])
+
+        np.testing.assert_allclose(self.inst1.epochs._data[0, 0, :], cubic, rtol=1e-6)
+
+
+
+    def test_cubic_interpolation_windows(self):
+        x = self.inst1.epochs.times*1000
+        orig_data = np.copy(self.inst1.epochs._data)
+        windows = [[-5, 5], [50, 60]]
+
+        inwin = np.zeros(len(x), dtype=bool)
+        for window in windows:
+            inwin[np.argmin(np.abs(x - window[0])):np.argmin(np.abs(x - window[1])) +1] = True
+
+        for support in [None, [5, 5]]:
+            self.inst1.epochs._data = np.copy(orig_data)
+            self.inst1.cubic_interpolation(windows, support)
+
+            # both windows are interpolated, the samples between them are untouched
+            assert np.all(self.inst1.epochs._data[:, :, inwin] != orig_data[:, :, inwin])
+            np.testing.assert_array_equal(self.inst1.epochs._data[:, :, ~inwin], orig_data[:, :, ~inwin])
+
+        # with local support, each window is filled as if interpolated on its own
+        expected = np.copy(orig_data)
+        self.inst1.epochs._data = expected
+        for window in windows:
+            self.inst1.cubic_interpolation(window, [5, 5])
+
+        self.inst1.epochs._data = np.copy(orig_data)
+        self.inst1.cubic_interpolation(windows, [5, 5])
+        np.testing.assert_allclose(self.inst1.epochs._data, expected, rtol=1e-12)
+
+
+
+    def test_cubic_interpolation_edge(self):
+        end = self.inst1.epochs.times[-1]*1000
+        start = self.inst1.epochs.times[0]*1000
+        orig_data = np.copy(self.inst1.epochs._data)
+
+        # windows reaching the end or start of the epoch can not be interpolated
+        with self.assertRaises(ValueError):
+            self.inst1.cubic_interpolation([end - 20, end])
+
+        with self.assertRaises(ValueError):
+            self.inst1.cubic_interpolation([start, start + 20])
+
+        np.testing.assert_array_equal(self.inst1.epochs._data, orig_data)
+
+
+
+    def test_cubic_interpolation_support_edge(self):
+        end = self.inst1.epochs.times[-1]*1000
+        orig_data = np.copy(self.inst1.epochs._data)
+
+        # the local fit needs samples on both sides of the window
+        with self.assertRaises(ValueError):
+            self.inst1.cubic_interpolation([end - 20, end], support=[5, 5])
+
+        np.testing.assert_array_equal(self.inst1.epochs._data, orig_data)
+
+
+
+    def test_cubic_interpolation_chunked(self):
+        orig_data = np.copy(self.inst1.epochs._data)
+
+        for support in [None, [5, 5]]:
+            self.inst1.epochs._data = np.copy(orig_data)
+            self.inst1.cubic_interpolation([-5, 15], support)
+            expected = np.copy(self.inst1.epochs._data)
+
+            # blocks of epochs give the same values as all epochs at once
+            self.inst1.epochs._data = np.copy(orig_data)
+            self.inst1.set_options({'chunksize': 7})
+            self.inst1.cubic_interpolation([-5, 15], support)
+            self.inst1.set_options({'chunksize': None})
+
+            np.testing.assert_array_equal(self.inst1.epochs._data, expected)
+
+
+
+    def test_to_memmap(self):
+        import tempfile
+        import mne
+
+        data = np.copy(self.inst1.epochs._data)
+        epochs = mne.EpochsArray(data, self.inst1.epochs.info, tmin=self.inst1.epochs.tmin, verbose=0)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            epochs.save(os.path.join(tmpdir, 'subject-epo.fif'), verbose=0)
+
+            # not preloaded epochs are streamed into the memory-mapped file
+            epochs = mne.read_epochs(os.path.join(tmpdir, 'subject-epo.fif'), preload=False, verbose=0)
+            inst = TMSRepair(epochs, options={'manualinput': 'off', 'chunksize': 7})
+            inst.to_memmap(os.path.join(tmpdir, 'subject.npy'))
+
+            assert isinstance(inst.epochs._data, np.memmap)
+            np.testing.assert_allclose(inst.epochs._data, data, rtol=1e-6)
+
+            inst.replace_with_zeros([-2, 10])
+            assert np.sum(np.abs(np.load(os.path.join(tmpdir, 'subject.npy'))[:, :, inst.repaired])) == 0
+
+            # the cleaned data is written into the memory-mapped file
+            inst.set_options({'confirm': 'off', 'compcheck': 'off'})
+            inst.fastica()
+            inst.compclass = np.ones(inst.options['comps'])
+            inst.compclass[0] = 6
+            inst.inverse_transform()
+            cleaned = np.moveaxis(inst.post, 2, 0)
+
+            inst.transform_epochs_object()
+
+            assert isinstance(inst.epochs._data, np.memmap)
+            np.testing.assert_array_equal(np.load(os.path.join(tmpdir, 'subject.npy')), cleaned)
+
+            del inst, epochs
+
+
+
+    def test_erp_preview(self):
+        from copy import deepcopy
+        import mne
+        from TMSRepair import TMSRepair_misc as misc
+
+        orig_data = np.copy(self.inst1.epochs._data)
+
+        # reference: interpolate and filter every trial, then average
+        epochs = misc.cubic_interpolation(deepcopy(self.inst1.epochs), [-5, 15])
+        epochs.filter(0.5, 49, method='iir', verbose=0)
+        epochs._data = mne.filter.notch_filter( epochs._data, epochs.info['sfreq'], 50, notch_widths=2, 
+                                                phase='zero', verbose=0)
+
+        erp = misc.erp_preview(self.inst1.epochs)
+
+        np.testing.assert_allclose(erp, epochs.average()._data, atol=1e-10*np.abs(erp).max())
+        np.testing.assert_array_equal(self.inst1.epochs._data, orig_data)
+
+
+
+    def example_signal(self):
         from scipy import signal
 
         # example signal from sklearn ICA
@@ -79,6 +281,13 @@ class TestTMSRepair(unittest.TestCase):
         self.inst1.epochs._data = np.transpose(X)[None, :,:]
         self.inst1.options['chanpicks'] = ['Fp1', 'Fp2', 'F3']
 
+        return X
+
+
+
+    def test_fastica(self):
+        X = self.example_signal()
+
         # call fast ICA function
         self.inst1.fastica()
 
@@ -93,6 +302,376 @@ class TestTMSRepair(unittest.TestCase):
 
 
 
+    def test_fastica_float32(self):
+        X = self.example_signal()
+        self.inst1.set_options({'seed': 0})
+
+        self.inst1.fastica()
+        S64, A64 = self.inst1.S, self.inst1.A
+
+        self.inst1.set_options({'dtype': 'float32'})
+        self.inst1.fastica()
+        S32, A32 = self.inst1.S, self.inst1.A
+
+        assert S32.dtype == np.float32
+
+        # same components (up to sign and order) and same reconstruction as in double precision
+        ncomps = np.shape(S64)[0]
+        corr = np.corrcoef(np.reshape(S64, [ncomps, -1]), np.reshape(S32, [ncomps, -1]))[:ncomps, ncomps:]
+        np.testing.assert_allclose(np.max(np.abs(corr), 1), 1, atol=1e-4)
+
+        post = np.dot(np.reshape(S32, [np.shape(S32)[0], -1]).T, A32.T) + self.inst1.mean
+        np.testing.assert_allclose(post, X, atol=1e-4)
+
+
+
+    def test_fastica_subsampled_fit(self):
+        X = self.example_signal()
+        self.inst1.set_options({'seed': 0})
+
+        self.inst1.fastica()
+        S = np.reshape(self.inst1.S, [3, -1])
+
+        self.inst1.set_options({'fit_decim': 4, 'fit_fraction': 0.5})
+        self.inst1.fastica()
+        S_sub = np.reshape(self.inst1.S, [3, -1])
+
+        # all samples are unmixed and reconstructed, the components match the full fit
+        assert np.shape(S_sub) == np.shape(S)
+        np.testing.assert_array_almost_equal(np.dot(S_sub.T, self.inst1.A.T) + self.inst1.mean, X)
+
+        corr = np.corrcoef(S, S_sub)[:3, 3:]
+        np.testing.assert_allclose(np.max(np.abs(corr), 1), 1, atol=1e-2)
+
+
+
+    def test_concat_columns(self):
+        from TMSRepair import TMSRepair_misc as misc
+
+        data = self.inst1.epochs._data
+        ch_idx = [0, 5, 7]
+        tidx = np.arange(0, np.shape(data)[2], 3)
+
+        # gathering sampled columns block-wise gives the columns of the full concatenation
+        cols = misc.sample_columns(len(tidx)*len(data), 0.3, 0)
+        full = misc.concat_epochs(data, ch_idx, tidx=tidx)
+
+        np.testing.assert_array_equal(misc.concat_epochs(data, ch_idx, chunksize=7, tidx=tidx, cols=cols), 
+                                      full[:, cols])
+
+
+
+    def test_fastica_repaired_excluded(self):
+        self.inst1.set_options({'seed': 0})
+        self.inst1.replace_with_zeros([-2, 10])
+        assert np.any(self.inst1.repaired)
+
+        self.inst1.fastica()
+        W = self.inst1.W
+
+        # the repaired timepoints do not influence the fit 
+        # (only the sorting, as the component variance is computed over all timepoints)
+        self.inst1.epochs._data[:, :, self.inst1.repaired] = np.random.randn(
+            len(self.inst1.epochs), len(self.inst1.epochs.ch_names), np.sum(self.inst1.repaired))
+        self.inst1.fastica()
+
+        order = [np.argmin(np.sum(np.abs(W - w), 1)) for w in self.inst1.W]
+        np.testing.assert_allclose(self.inst1.W, W[order])
+
+
+
+    def test_fastica_warm_start(self):
+        import io
+        import contextlib
+
+        self.inst1.set_options({'seed': 0})
+        self.inst1.fastica()
+        S = np.reshape(self.inst1.S, [len(self.inst1.W), -1])
+
+        # starting from the converged unmixing matrix gives the same components
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.inst1.fastica(warm_start=True)
+        assert 'starting from the previous decomposition' in out.getvalue()
+
+        S_warm = np.reshape(self.inst1.S, [len(self.inst1.W), -1])
+
+        ncomps = len(S)
+        corr = np.corrcoef(S, S_warm)[:ncomps, ncomps:]
+        np.testing.assert_allclose(np.max(np.abs(corr), 1), 1, atol=1e-6)
+
+
+
+    def test_fastica_rank_deficient(self):
+        # average reference removes one dimension of the data
+        self.inst1.epochs._data -= np.mean(self.inst1.epochs._data, axis=1, keepdims=True)
+        nchans = len(self.inst1.options['chanpicks'])
+
+        self.inst1.fastica()
+
+        assert self.inst1.rank == nchans - 1
+        assert self.inst1.options['comps'] <= self.inst1.rank
+        assert np.shape(self.inst1.W) == (nchans - 1, nchans)
+
+
+
+    def test_fastica_pca_compression(self):
+        self.inst1.set_options({'pcacomps': 10})
+        self.inst1.fastica()
+
+        assert self.inst1.rank == 10
+        assert self.inst1.options['comps'] == 10
+        assert np.shape(self.inst1.W) == (10, len(self.inst1.options['chanpicks']))
+
+        self.inst1.set_options({'pcacomps': None, 'pcavar': 0.9})
+        self.inst1.fastica()
+
+        assert self.inst1.rank < len(self.inst1.options['chanpicks'])
+        assert np.shape(self.inst1.S)[0] == self.inst1.rank
+        assert self.inst1.options['comps'] == self.inst1.rank
+
+        # without compression, the requested number of components is used again
+        self.inst1.set_options({'pcavar': None})
+        self.inst1.fastica()
+
+        assert self.inst1.options['comps'] == min(len(self.inst1.options['chanpicks']), self.inst1.rank) > 10
+
+
+
+    def test_fastica_cache(self):
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as cachedir:
+            self.inst1.set_options({'cachedir': cachedir, 'seed': 0})
+
+            self.inst1.fastica()
+            A = self.inst1.A
+
+            # change the data the cache is keyed on, then change it back
+            orig = self.inst1.epochs._data[0, 0, 0]
+            self.inst1.epochs._data[0, 0, 0] = orig + 1
+            self.inst1.fastica()
+            self.inst1.epochs._data[0, 0, 0] = orig
+            self.inst1.fastica()
+
+            assert len(os.listdir(cachedir)) == 2
+            np.testing.assert_array_equal(self.inst1.A, A)
+
+            # a decomposition in single precision is not loaded for double precision
+            self.inst1.set_options({'dtype': 'float32'})
+            self.inst1.fastica()
+            assert len(os.listdir(cachedir)) == 3
+
+            # a damaged or partly written file is a cache miss, and no temporary files are left
+            from TMSRepair import TMSRepair_misc as misc
+            with open(os.path.join(cachedir, 'damaged.npz'), 'wb') as file:
+                file.write(b'PK')
+            assert misc.cache_load(cachedir, 'damaged') is None
+            assert not [f for f in os.listdir(cachedir) if f.endswith('.tmp')]
+
+
+
+    def test_fastica_cache_rank_deficient(self):
+        import io
+        import contextlib
+        import tempfile
+
+        # average reference, the data has one dimension less than channels
+        self.inst1.epochs._data -= np.mean(self.inst1.epochs._data, axis=1, keepdims=True)
+
+        with tempfile.TemporaryDirectory() as cachedir:
+            self.inst1.set_options({'cachedir': cachedir, 'seed': 0})
+            self.inst1.fastica()
+
+            # the number of components adjusted to the rank does not change the cache key
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                self.inst1.fastica()
+
+            assert 'loaded from cache' in out.getvalue()
+            assert len(os.listdir(cachedir)) == 1
+
+
+
+    def test_inverse_transform_incremental(self):
+        self.inst1.set_options({'confirm': 'off', 'compcheck': 'off'})
+
+        self.inst1.fastica()
+        self.inst1.compclass = np.ones(self.inst1.options['comps'])
+        self.inst1.inverse_transform()
+
+        # reject two components, accept one of them again
+        self.inst1.compclass[[0, 3]] = 6
+        self.inst1.inverse_transform()
+        self.inst1.compclass[3] = 1
+        self.inst1.inverse_transform()
+
+        # full reconstruction without component 0
+        good = np.arange(1, np.shape(self.inst1.S)[0])
+        expected = np.tensordot(self.inst1.A[:, good], np.asarray(self.inst1.S)[good], axes=1)
+        expected += self.inst1.mean[:, None, None]
+
+        np.testing.assert_allclose(self.inst1.post, expected, atol=1e-12*np.abs(expected).max())
+
+
+
+    def test_transform_inplace(self):
+        from copy import deepcopy
+
+        inst2 = TMSRepair(deepcopy(self.inst1.epochs), options={'manualinput': 'off', 'inplace': 'on'})
+
+        for inst in [self.inst1, inst2]:
+            inst.set_options({'confirm': 'off', 'compcheck': 'off', 'seed': 0, 'chunksize': 7})
+            inst.fastica()
+            inst.compclass = np.ones(inst.options['comps'])
+            inst.compclass[[0, 2]] = 6
+            inst.inverse_transform()
+            inst.transform_epochs_object()
+
+        # projecting epochs._data in place gives the data of the reconstruction
+        assert not hasattr(inst2, 'post')
+        np.testing.assert_allclose(inst2.epochs._data, self.inst1.epochs._data, 
+                                   atol=1e-10*np.abs(self.inst1.epochs._data).max())
+
+
+
+    def test_transform_blocks(self):
+        from copy import deepcopy
+        from TMSRepair import TMSRepair_misc as misc
+
+        inst2 = TMSRepair(deepcopy(self.inst1.epochs), options={'manualinput': 'off'})
+
+        # without a chunksize, the data is transformed in blocks of about block_bytes
+        block_bytes = misc.block_bytes
+        try:
+            for inst, nbytes in [(self.inst1, block_bytes), (inst2, 64*1000*8*4)]:
+                misc.block_bytes = nbytes
+                inst.set_options({'confirm': 'off', 'compcheck': 'off', 'seed': 0, 'inplace': 'on'})
+                inst.fastica()
+                inst.compclass = np.ones(inst.options['comps'])
+                inst.compclass[[0, 2]] = 6
+                inst.inverse_transform()
+                inst.transform_epochs_object()
+        finally:
+            misc.block_bytes = block_bytes
+
+        assert misc.block_size(64*1000*8*4, 7) == 7
+        np.testing.assert_allclose(inst2.epochs._data, self.inst1.epochs._data, 
+                                   rtol=1e-12, atol=1e-12*np.abs(self.inst1.epochs._data).max())
+
+
+
+    def test_sources_data_changed(self):
+        self.inst1.fastica()
+
+        # fill the cached time courses and mean, then change the data
+        self.inst1.S[0]
+        self.inst1.S.mean(axis=2)
+        self.inst1.replace_with_zeros([-100, 100])
+
+        S = np.asarray(self.inst1.S)
+        np.testing.assert_allclose(self.inst1.S[0], S[0], rtol=1e-12, atol=1e-12*np.abs(S).max())
+        np.testing.assert_allclose(self.inst1.S.mean(axis=2), S.mean(axis=2), rtol=1e-12, atol=1e-12*np.abs(S).max())
+
+
+
+    def test_transform_restore(self):
+        self.inst1.set_options({'confirm': 'off', 'compcheck': 'off'})
+        ch_idx = [  i for i, chan in enumerate(self.inst1.epochs.ch_names)
+                    if chan in self.inst1.options['chanpicks']]
+        X = np.moveaxis(self.inst1.epochs._data[:, ch_idx, :], 0, 2).copy()
+
+        self.inst1.fastica()
+        self.inst1.compclass = np.ones(self.inst1.options['comps'])
+        self.inst1.compclass[0] = 6
+        self.inst1.inverse_transform()
+
+        # the transformed data is written into the same array
+        data = self.inst1.epochs._data
+        self.inst1.transform_epochs_object()
+        assert self.inst1.epochs._data is data
+
+        # the rejected component can be restored after the transform, also in the data
+        self.inst1.compclass[0] = 1
+        self.inst1.inverse_transform()
+        np.testing.assert_allclose(self.inst1.post, X, atol=1e-10*np.abs(X).max())
+
+        self.inst1.transform_epochs_object()
+        np.testing.assert_allclose(np.moveaxis(data[:, ch_idx, :], 0, 2), X, atol=1e-10*np.abs(X).max())
+
+
+
+    def test_component_spectra(self):
+        from scipy import fft
+        from scipy.stats import zscore
+        from TMSRepair import TMSRepair_misc as misc
+
+        self.inst1.fastica()
+        sfreq = self.inst1.epochs.info['sfreq']
+        plotfreqx = self.inst1.options['plotfreqx']
+        S = np.asarray(self.inst1.S)[:3]
+
+        # reference: the per-bin loop over all epochs
+        _, L, nevents = np.shape(S)
+        NFFT = 2**np.ceil(np.log2(abs(L)))
+        f = sfreq/2 * np.linspace(0, 1, int(NFFT/2+1))
+        freq = np.arange(plotfreqx[0], plotfreqx[1]+ 0.5, 0.5)
+        Yout = np.abs(fft.rfft(zscore(S, axis=1), n=int(NFFT), axis=1)/L)**2
+
+        expected = np.zeros([3, len(freq)])
+        for ia, a in enumerate(freq):
+            index1 = np.argmin(np.abs(f-(a-0.25)))
+            index2 = np.argmin(np.abs(f-(a+0.25)))
+            expected[:, ia] = np.sum(np.mean(Yout[:, index1:index2,:], 1), 1)/nevents
+
+        np.testing.assert_allclose(misc.component_spectra(self.inst1.S, sfreq, plotfreqx, range(3)), 
+                                   expected, rtol=1e-10)
+
+
+
+    def test_sources_blocks(self):
+        from TMSRepair import TMSRepair_misc as misc
+
+        self.inst1.fastica()
+        S = np.asarray(self.inst1.S)
+        spectra = misc.component_spectra(self.inst1.S, self.inst1.epochs.info['sfreq'], [1, 100], range(3))
+
+        # without a chunksize, the epochs are still processed in bounded blocks
+        block_bytes = misc.block_bytes
+        misc.block_bytes = 3*S.shape[1]*S.itemsize*4
+        try:
+            self.inst1.S.clear()
+            blocks = [sl for sl, _ in self.inst1.S.chunks(range(3))]
+            assert len(blocks) == int(np.ceil(S.shape[2]/4))
+
+            atol = 1e-12*np.abs(S).max()
+            np.testing.assert_allclose(np.asarray(self.inst1.S), S, rtol=1e-12, atol=atol)
+            np.testing.assert_allclose(self.inst1.S[1], S[1], rtol=1e-12, atol=atol)
+            np.testing.assert_allclose(misc.component_spectra(  self.inst1.S, self.inst1.epochs.info['sfreq'], 
+                                                                [1, 100], range(3)), spectra, rtol=1e-12)
+        finally:
+            misc.block_bytes = block_bytes
+
+
+
+    def test_display_decimation(self):
+        from TMSRepair import TMSRepair_misc as misc
+
+        x = self.inst1.epochs.times*1000
+        y = self.inst1.epochs._data[0]
+        y[3, 123] = 1
+
+        # bounded number of vertices, peaks kept
+        xd, yd = misc.minmax_envelope(x, y, 100)
+        assert np.shape(yd) == (np.shape(y)[0], 200) and len(xd) == 200
+        np.testing.assert_array_equal(np.max(yd, 1), np.max(y, 1))
+        np.testing.assert_array_equal(np.min(yd, 1), np.min(y, 1))
+
+        M = misc.decimate_image(-y, (10, 50))
+        assert np.shape(M) == (10, 50) and np.min(M) == -1
+
+
+
     def test_compselect(self):
         self.inst1.options['confirm'] = 'off'
         self.inst1.options['compcheck'] = 'off'
@@ -127,5 +706,221 @@ class TestTMSRepair(unittest.TestCase):
 
 
 
+    def test_compselect_rethreshold(self):
+        self.inst1.set_options({'confirm': 'off', 'compcheck': 'off'})
+
+        self.inst1.fastica()
+        self.inst1.compselect()
+        features = self.inst1.features
+
+        # only thresholds changed: the stored features are reused
+        self.inst1.set_options({'elecnoisethresh': 0, 'tmsmuscle': 'off', 'blink': 'off',
+                                'move': 'off', 'muscle': 'off'})
+        self.inst1.compselect()
+
+        assert self.inst1.features is features
+        assert np.all(self.inst1.compclass == 6)
+
+        # thresholds for many settings at once
+        from TMSRepair import TMSRepair_misc as misc
+        compclass = misc.classify(features, dict(self.inst1.options, elecnoisethresh=np.array([[0], [np.inf]])))
+        np.testing.assert_array_equal(compclass, [np.full(len(features), 6), np.ones(len(features))])
+
+
+
+    def test_run_batch(self):
+        import shutil
+        import tempfile
+        import mne
+        from TMSRepair import TMSRepair_batch as batch
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shutil.copy('tests/testdata/example_epochs.p', tmpdir)
+
+            results = batch.run_batch(tmpdir, tmpdir, {'seed': 0}, n_jobs=1, blas_threads=1)
+            assert len(results) == 1 and 'error' not in results[0], results
+
+            # the repaired epochs can be read back, and are not picked up by a second run
+            epochs = mne.read_epochs(results[0]['output'], verbose=0)
+            assert np.shape(epochs.get_data()) == np.shape(self.inst1.epochs._data)
+            assert os.path.exists(results[0]['features'])
+
+            results = batch.run_batch(tmpdir, tmpdir, {'seed': 0}, n_jobs=1, blas_threads=1)
+            assert [result['subject'] for result in results] == ['example_epochs']
+
+
+
+    def test_features_switched_off(self):
+        self.inst1.set_options({'confirm': 'off', 'compcheck': 'off', 'muscle': 'off', 'plotfreqx': [0, 100]})
+
+        self.inst1.fastica()
+        self.inst1.compselect()
+
+        # no spectra are needed, the features of rules switched off are nan
+        assert not hasattr(self.inst1, 'fftbins')
+        assert np.all(np.isnan(self.inst1.features['muscle']))
+
+        # switching a rule on computes its feature, bins at 0 Hz are left out of the fit
+        features = self.inst1.features
+        self.inst1.set_options({'muscle': 'on'})
+        self.inst1.compselect()
+        assert self.inst1.features is not features and hasattr(self.inst1, 'fftbins')
+
+
+
+    def test_threshold_sweep(self):
+        from TMSRepair import TMSRepair_batch as batch
+
+        self.inst1.fastica()
+        ncomps = self.inst1.options['comps']
+
+        options = {'tmsmuscle': 'off', 'blink': 'off', 'move': 'off', 'muscle': 'off'}
+        result = batch.threshold_sweep([self.inst1, self.inst1.compute_features()], {'elecnoisethresh': [0, np.inf]}, options)
+
+        assert result['settings'] == [{'elecnoisethresh': 0}, {'elecnoisethresh': np.inf}]
+        np.testing.assert_array_equal(result['counts'][0, :, 5], [ncomps, ncomps])
+        np.testing.assert_array_equal(result['counts'][1, :, 0], [ncomps, ncomps])
+        np.testing.assert_allclose(result['perc_var_removed'][0], np.sum(self.inst1.perc_var[:ncomps]))
+        np.testing.assert_array_equal(result['perc_var_removed'][1], 0)
+
+
+
+    def test_classifier(self):
+        import tempfile
+        from TMSRepair import TMSRepair_batch as batch
+
+        self.inst1.set_options({'confirm': 'off', 'compcheck': 'off'})
+        self.inst1.fastica()
+        self.inst1.compselect()
+
+        # reviewed labels: the two largest components are electrode noise
+        labels = np.ones(self.inst1.options['comps'])
+        labels[:2] = 6
+        self.inst1.compclass = labels
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'classifier.p')
+            batch.train_classifier([self.inst1], fname)
+
+            compclass = batch.classify_batch([self.inst1, self.inst1], fname)
+            np.testing.assert_array_equal(compclass[0], labels)
+            np.testing.assert_array_equal(compclass[1], labels)
+
+            self.inst1.set_options({'classifier': fname})
+            self.inst1.compselect()
+            np.testing.assert_array_equal(self.inst1.compclass, labels)
+
+
+
+    def test_render_panels_backend(self):
+        import tempfile
+        import matplotlib
+
+        self.inst1.set_options({'confirm': 'off', 'compcheck': 'off', 'comps': 2})
+        self.inst1.fastica()
+        self.inst1.compselect()
+
+        # rendering in this process keeps the backend of the caller
+        backend = matplotlib.get_backend()
+        matplotlib.use('svg')
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                fnames = self.inst1.render_panels(n_jobs=1, paneldir=tmpdir)
+                assert all(os.path.exists(fname) for fname in fnames)
+                assert matplotlib.get_backend() == 'svg'
+
+                self.inst1.report(os.path.join(tmpdir, 'subject_report.html'), n_jobs=1, paneldir=tmpdir)
+                assert matplotlib.get_backend() == 'svg'
+        finally:
+            matplotlib.use(backend)
+
+
+
+    def test_render_panels_eviction(self):
+        import tempfile
+
+        self.inst1.set_options({'confirm': 'off', 'compcheck': 'off', 'comps': 2, 'cachesize': 1e-3})
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            open(os.path.join(tmpdir, 'other.txt'), 'w').close()
+
+            # the panels of earlier decompositions are removed beyond cachesize, other files are kept
+            for seed in [0, 1]:
+                self.inst1.set_options({'seed': seed})
+                self.inst1.fastica()
+                self.inst1.compselect()
+                fnames = self.inst1.render_panels(n_jobs=1, paneldir=tmpdir)
+
+            assert sorted(os.listdir(tmpdir)) == sorted(['other.txt', os.path.basename(os.path.dirname(fnames[0]))])
+            assert all(os.path.exists(fname) for fname in fnames)
+
+
+
+    def test_report_labels(self):
+        import tempfile
+        import json
+
+        self.inst1.set_options({'confirm': 'off', 'compcheck': 'off', 'comps': 4})
+        self.inst1.fastica()
+        self.inst1.compselect()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = self.inst1.report(os.path.join(tmpdir, 'subject_report.html'), n_jobs=1, 
+                                        paneldir=tmpdir, title='subject')
+
+            with open(fname) as file:
+                page = file.read()
+
+            assert page.count('data:image/png;base64') == 5
+            assert page.count('<select data-comp') == 4
+
+            # labels as exported from the report
+            labels = json.loads(page.split('var labels = ')[1].split(';')[0])
+            labels['compclass'] = [6, 1, 1, 1]
+            with open(os.path.join(tmpdir, 'subject_labels.json'), 'w') as file:
+                json.dump(labels, file)
+
+            self.inst1.apply_labels(os.path.join(tmpdir, 'subject_labels.json'))
+            np.testing.assert_array_equal(self.inst1.compclass, [6, 1, 1, 1])
+
+            # labels of another decomposition are not applied
+            labels['decomposition'] = 'other'
+            with open(os.path.join(tmpdir, 'subject_labels.json'), 'w') as file:
+                json.dump(labels, file)
+
+            with self.assertRaises(ValueError):
+                self.inst1.apply_labels(os.path.join(tmpdir, 'subject_labels.json'))
+
+
+
+
+    def test_run_batch_labels(self):
+        import shutil
+        import tempfile
+        import json
+        from TMSRepair import TMSRepair_batch as batch
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            shutil.copy('tests/testdata/example_epochs.p', tmpdir)
+            outdir = os.path.join(tmpdir, 'out')
+
+            # without a seed, the labels are applied to the decomposition saved with the report
+            results = batch.run_batch(tmpdir, outdir, {'comps': 4}, n_jobs=1, blas_threads=1, report=True)
+            with open(results[0]['report']) as file:
+                labels = json.loads(file.read().split('var labels = ')[1].split(';')[0])
+
+            labels['compclass'] = [6, 1, 1, 1]
+            with open(os.path.join(tmpdir, 'example_epochs_labels.json'), 'w') as file:
+                json.dump(labels, file)
+
+            results = batch.run_batch(tmpdir, outdir, {'comps': 4}, n_jobs=1, blas_threads=1, labeldir=tmpdir)
+            assert 'error' not in results[0], results
+            assert results[0]['compclass'] == [6, 1, 1, 1]
+
+            # a new outdir has no saved decompositions
+            with self.assertRaises(ValueError):
+                batch.run_batch(tmpdir, os.path.join(tmpdir, 'new'), {'comps': 4}, labeldir=tmpdir)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file